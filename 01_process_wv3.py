@@ -12,12 +12,35 @@ CREDENTIALS = "D:/arqueologia-proceso-copiaseguridad/codigo-zenodo/earthengine-p
 # client_email inside private key JSON
 SERVICE_ACCOUNT = "id-s-atmosphericcorrection@s-correction.iam.gserviceaccount.com" 
 
+# Skip the stages whose inputs did not change since the last run
+INCREMENTAL = True
+
+# Also write the ARC (radiance) image computed before the 6S correction
+# (only to debug, the correction is computed in one pass without it)
+KEEP_ARC = False
+
+# Number of CPU cores used by the radiometric correction (and the 6S runs)
+WORKERS = 1
+
+# Write the clipped/translated images as virtual datasets (VRT) instead of
+# GeoTIFF. The clip is computed while the radiometric correction reads them
+VIRTUAL_PRETREATMENT = False
+
+# Folder to store the 6S outputs (empty to always run 6S). Scenes with the
+# same 6S inputs reuse them
+SIXS_CACHE = ""
+# Optional 6S lookup table built around each scene (only with SIXS_CACHE),
+# later scenes of the same site and season are interpolated from it
+SIXS_LUT = None
+# e.g. SIXS_LUT = {'solar_z': [20, 30, 40, 50, 60], 'aot': [0.05, 0.2, 0.4, 0.8], 'h2o': [0.5, 1.5, 3, 5]}
+
 # ONLY CHANGE CODE ABOVE TO THIS LINE ----------------------------------------->
 
 # Import packages
 import os
 from xml.dom import minidom
 import customfunctions as cf
+import manifest as mf
 
 ROOT = os.path.abspath(os.path.join(MUL_PATH, os.pardir))
 OUTPUT_DIR = os.path.join(ROOT, 'processed_data')
@@ -32,6 +55,19 @@ PROCESSED_MUL = ""
 # Store the last PAN processed image
 PROCESSED_PAN = ""
 
+# Fingerprints of the inputs of each stage
+MANIFEST = mf.load_manifest(OUTPUT_DIR)
+PROCESSED_KEYS = {}
+
+def run_stage(stage: str, key: str, outputs: list) -> bool:
+    """
+    Return True if the stage must be computed (its inputs changed).
+    """
+    if INCREMENTAL and mf.is_fresh(MANIFEST, stage, key, outputs):
+        print(f'..Skip {stage}: inputs did not change\n')
+        return False
+    return True
+
 for folder in [MUL_PATH, PAN_PATH]:
     # Select the image
     IMAGE = cf.listFiles(folder, 'TIL')[0]
@@ -51,49 +87,81 @@ for folder in [MUL_PATH, PAN_PATH]:
     print("Computed image: "+ image_name +"\n")
     print("==== PRETREATMEANTS ====\n")
     # Output image path
-    output_tiff = os.path.join(OUTPUT_DIR, image_name + '.tif')
+    pretreatment_format = 'VRT' if VIRTUAL_PRETREATMENT else 'GTiff'
+    output_tiff = os.path.join(OUTPUT_DIR, image_name + ('.vrt' if VIRTUAL_PRETREATMENT else '.tif'))
 
+    # Raw inputs: TIL file and its tiles
+    raw_hashes = [mf.file_hash(f, MANIFEST) for f in [IMAGE] + cf.listFiles(folder, 'TIF')]
     if len(AOI_PATH) != 0:
-        print('..Clip image '+ image_name +'\n')
-        
-        output = cf.clip(resx, resy, AOI_PATH, IMAGE, output_tiff)
-        # Handle possible errors in AOI path 
-        print(output[0], '\n')
-        print(output[1], '\n')
-        
-        IMAGE = output_tiff
-        
+        key = mf.fingerprint(
+            'clip', raw_hashes, mf.file_hash(AOI_PATH, MANIFEST), resx, resy, pretreatment_format
+        )
     else:
-        print('..Translate TIL to TIF '+ image_name +'\n')
-        output = cf.translate(resx, resy, IMAGE, output_tiff)
-        print(output[0], '\n')
-        print(output[1], '\n')
-        IMAGE = output_tiff
+        key = mf.fingerprint('translate', raw_hashes, resx, resy, pretreatment_format)
+
+    if run_stage(image_name + '_pretreatment', key, [output_tiff]):
+        if len(AOI_PATH) != 0:
+            print('..Clip image '+ image_name +'\n')
+            
+            output = cf.clip(resx, resy, AOI_PATH, IMAGE, output_tiff, pretreatment_format)
+            # Handle possible errors in AOI path 
+            print(output[0], '\n')
+            print(output[1], '\n')
+            
+        else:
+            print('..Translate TIL to TIF '+ image_name +'\n')
+            output = cf.translate(resx, resy, IMAGE, output_tiff, pretreatment_format)
+            print(output[0], '\n')
+            print(output[1], '\n')
+        mf.record(MANIFEST, image_name + '_pretreatment', key, [output_tiff])
+    IMAGE = output_tiff
 
     print('==== ATMOSPHERIC CORRECTION ====\n')
-    print('..ARC transformation\n')
     output_arc = os.path.join(OUTPUT_DIR, image_name + '_ARC.tif')
-    output = cf.ARC(IMAGE, output_arc, IMD)
-    print(output[0], '\n')
-    print(output[1], '\n')
-    IMAGE = output_arc
-
-    print('..6S Atmospheric correction\n')
     output_sixs = os.path.join(OUTPUT_DIR, image_name + '_6S.tif')
-    output = cf.sixs(IMAGE, output_sixs, XML, CREDENTIALS, SERVICE_ACCOUNT, IMD)
-    print(output[0], '\n')
-    print(output[1], '\n')
+    output_coefficients = os.path.join(OUTPUT_DIR, image_name + '_6S_coefficients.csv')
+    outputs = [output_sixs, output_coefficients]
+    if KEEP_ARC:
+        outputs.append(output_arc)
+    # ARC parameters come from the IMD and the radiometric use file, 6S
+    # parameters from the image metadata (date, angles, footprint)
+    key = mf.fingerprint(
+        'ARC+6S', key, IMD, mf.file_hash(cf.RADIOMETRIC_USE, MANIFEST), XML.toxml(), KEEP_ARC,
+        SIXS_LUT if len(SIXS_CACHE) != 0 else None
+    )
+    if run_stage(image_name + '_6S', key, outputs):
+        print('..ARC coefficients\n')
+        arc = cf.arc_coefficients(IMD)
+        if len(SIXS_CACHE) != 0 and SIXS_LUT is not None:
+            print('..6S lookup tables\n')
+            cf.sixs_luts(XML, CREDENTIALS, SERVICE_ACCOUNT, IMD, SIXS_CACHE, SIXS_LUT, workers = WORKERS)
+        print('..6S coefficients\n')
+        sixs = cf.sixs_coefficients(
+            XML, CREDENTIALS, SERVICE_ACCOUNT, IMD, workers = WORKERS,
+            cache_dir = SIXS_CACHE if len(SIXS_CACHE) != 0 else None
+        )
+        cf.write_coefficients(arc, sixs, output_coefficients)
+        print('..ARC + 6S Atmospheric correction\n')
+        cf.radiometric_correction(
+            IMAGE, output_sixs, arc, sixs,
+            arc_image = output_arc if KEEP_ARC else None, workers = WORKERS
+        )
+        mf.record(MANIFEST, image_name + '_6S', key, outputs)
     IMAGE = output_sixs
 
     if folder == MUL_PATH:
         PROCESSED_MUL = IMAGE
     else:
         PROCESSED_PAN = IMAGE
+    PROCESSED_KEYS[folder] = key
 
 print('==== PANSHARPENING ====\n')
 print("\n..Compute wBrovey pansharpening\n\n")
 output_brovey = os.path.join(OUTPUT_DIR, image_name + '_wBrovey.tif')
 # Note: Mul image must not be resize
-output = cf.wBrovey(PROCESSED_MUL, PROCESSED_PAN, output_brovey)
-print(output[0], '\n')
-print(output[1], '\n')
\ No newline at end of file
+key = mf.fingerprint('wBrovey', PROCESSED_KEYS[MUL_PATH], PROCESSED_KEYS[PAN_PATH])
+if run_stage(image_name + '_wBrovey', key, [output_brovey]):
+    output = cf.wBrovey(PROCESSED_MUL, PROCESSED_PAN, output_brovey)
+    print(output[0], '\n')
+    print(output[1], '\n')
+    mf.record(MANIFEST, image_name + '_wBrovey', key, [output_brovey])
\ No newline at end of file
@@ -7,6 +7,45 @@ WV3_PSH = "D:/arqueologia-proceso-copiaseguridad/codigo-zenodo/test_images/wv3/0
 # Georreferenced CORONA image
 CORONA = "D:/arqueologia-proceso-copiaseguridad/codigo-zenodo/test_images/corona/D3C1207-100019A030_g_zar_tepe_grd_clip.tif"
 
+# Number of CPU cores used to compute the neochannels
+WORKERS = 1
+
+# Write all the WV3 neochannels (indices and PCs) with the same resolution
+# inside one multiband image instead of one image per neochannel
+STACKED_OUTPUT = False
+# Stack format: GTiff (tiled GeoTIFF) | Zarr (chunked array store)
+STACK_FORMAT = "GTiff"
+
+# PCA estimation matrix: Covariance | Correlation (use Correlation when the
+# bands have very different ranges)
+PCA_ESTIMATOR = "Covariance"
+# Fraction of the image pixels (native block rows) used to estimate the PCA
+# covariance matrix. 1 uses all the pixels, lower values are faster (see
+# pca.sampling_report to choose a safe fraction)
+PCA_SAMPLE_FRACTION = 1
+# Compute the covariance matrix of all the bands once per image and share
+# it with every PCA combination (pixels valid in all the bands are used)
+PCA_SHARED_MOMENTS = True
+# Project all the PCA combinations reading the image once (it always uses
+# the shared covariance matrix)
+PCA_BATCH = True
+# Only write the best K PCA combinations of each number of bands, ranked by
+# the variance explained by their first 3 PCs (None to write all of them).
+# The ranking is saved in pca_band_ranking.csv
+PCA_TOP_K = None
+# Minimum explained variance (%) to write a PCA combination (or None)
+PCA_MIN_EXPLAINED = None
+
+# CORONA focal filter bank written as one multiband image, list of
+# (filter, kernel size) with filter highpass | contrast. None only computes
+# the 5x5 high pass filter
+FOCAL_BANK = None
+# e.g. FOCAL_BANK = [("highpass", 3), ("highpass", 5), ("highpass", 9), ("highpass", 15)]
+
+# Skip the neochannels whose inputs did not change since the last run
+# (only with STACKED_OUTPUT = False)
+INCREMENTAL = True
+
 # ONLY CHANGE CODE ABOVE TO THIS LINE ----------------------------------------->
 
 bands_pos = [1, 2, 3, 4, 5, 6, 7, 8]
@@ -20,56 +59,256 @@ import indices as spin
 import pca
 import customfunctions as cf
 import highpassfilter as hpf
+import rasterblocks as rb
+import manifest as mf
 
 ROOT = os.path.abspath(os.path.join(__file__, os.pardir))
 cf.createDir(ROOT, 'neochannels')
 
+def write_pca(task: dict, img_hash: str, stack = None):
+    """
+    Write the PCA combinations of one image whose inputs changed, with
+    their stats and fitted models.
+
+    :task: Dict with the image path, bands, combinations and output dir.
+    :img_hash: Image hash (see manifest.file_hash).
+    :stack: Open stack where the PCs are written (see STACKED_OUTPUT) or
+    None to write one image by combination.
+    """
+    OUTPUT_DIR = task['output_dir']
+    combis_dict = task['combis']
+    incremental = INCREMENTAL and stack is None
+    shared_moments = PCA_SHARED_MOMENTS or PCA_BATCH
+    # Combinations to compute with their outputs and fingerprints
+    stale_combis = {}
+
+    for combi_id, combi_bands in combis_dict.items():
+        name = os.path.basename(task['image_path']).split('.')[0]
+        out_name = '_'.join([name, task['folder'], 'C' + str(combi_id)])
+        if stack is not None:
+            pc_bands = [
+                rb.stack_band(stack, f'{task["folder"]}_C{combi_id}_PC{i + 1}')
+                for i in range(pca.N_PC)
+            ]
+            img_out_path = (stack, pc_bands)
+        else:
+            img_out_path = os.path.join(OUTPUT_DIR, out_name + '.tif')
+        out_stats = os.path.join(OUTPUT_DIR, out_name +'_stats.csv')
+        # Fitted model, it can be applied to other images (pca.apply_model)
+        out_model = os.path.join(OUTPUT_DIR, out_name +'_model.json')
+
+        # PCA fingerprint: image and combination bands
+        stage = '_'.join([task['folder'], 'C' + str(combi_id)])
+        key = mf.fingerprint(
+            'pca', img_hash, combi_bands, task['bands'], pca.N_PC,
+            shared_moments, PCA_ESTIMATOR, PCA_SAMPLE_FRACTION
+        )
+        if incremental and mf.is_fresh(MANIFEST, stage, key, [img_out_path, out_stats, out_model]):
+            print(f"..Skip combi {combi_id}: inputs did not change\n")
+            continue
+        stale_combis[combi_id] = {
+            'out_path': img_out_path,
+            'out_stats': out_stats,
+            'out_model': out_model,
+            'stage': stage,
+            'key': key
+        }
+
+    if len(stale_combis) == 0:
+        return
+
+    # Band moments shared by all the combinations
+    moments = None
+    if shared_moments and task['moments'] is not None:
+        moments = task['moments']
+    elif shared_moments:
+        moments = pca.band_moments(
+            task['image_path'], list(range(1, len(task['bands']) + 1)),
+            sample_fraction = PCA_SAMPLE_FRACTION
+        )
+
+    stale_bands = {combi_id: combis_dict[combi_id] for combi_id in stale_combis}
+    stale_paths = {combi_id: c['out_path'] for combi_id, c in stale_combis.items()}
+    model_paths = {combi_id: c['out_model'] for combi_id, c in stale_combis.items()}
+    if PCA_BATCH:
+        print(f"\nWriting PCA from {len(stale_combis)} combis at once\n")
+        print(f"==========================================\n")
+        results = pca.compute_pca_batch(
+            task['image_path'], stale_bands, stale_paths, PCA_ESTIMATOR, moments=moments,
+            overviews=False, model_paths=model_paths, sample_fraction=PCA_SAMPLE_FRACTION
+        )
+    else:
+        # Create PCA images (WORKERS combinations at the same time)
+        print(f"\nWriting PCA from {len(stale_combis)} combis with {WORKERS} workers\n")
+        print(f"==========================================\n")
+        results = pca.compute_pca_combis(
+            task['image_path'], stale_bands, stale_paths, PCA_ESTIMATOR, moments=moments,
+            workers=WORKERS, overviews=False, model_paths=model_paths,
+            sample_fraction=PCA_SAMPLE_FRACTION
+        )
+
+    # compute the pyramids of all the PCA images at once
+    if stack is None:
+        rb.build_overviews(list(stale_paths.values()), WORKERS)
+
+    for combi_id, c in stale_combis.items():
+        eigenvals, eigenvectors = results[combi_id]
+        # Write stats
+        pca.write_stats(eigenvals, eigenvectors, c['out_stats'], "csv")
+        if stack is None:
+            mf.record(MANIFEST, c['stage'], c['key'], [c['out_path'], c['out_stats'], c['out_model']])
+
 if len(WV3_PSH) > 0 and len(WV3_MUL) > 0:
 
-    print("==== SPECTRAL INDICES (WV3 image) ====\n")
     image_name = os.path.basename(WV3_PSH).split('.')[0]
-    OUTPUT_DIR = os.path.join(ROOT, f'neochannels/{image_name}/indices')
+    INDICES_DIR = os.path.join(ROOT, f'neochannels/{image_name}/indices')
     cf.createDir(ROOT, f'neochannels/{image_name}')
     cf.createDir(ROOT, f'neochannels/{image_name}/indices')
-    spin.compute_all_indices(WV3_PSH, bands_pos, bands_key, OUTPUT_DIR, img_120cm_path = WV3_MUL)
 
-    print("==== PCA (WV3 image) ====\n")
+    # Fingerprints of the neochannel inputs
+    MANIFEST = mf.load_manifest(os.path.join(ROOT, f'neochannels/{image_name}'))
+    incremental = INCREMENTAL and not STACKED_OUTPUT
+    img_hashes = {
+        WV3_PSH: mf.file_hash(WV3_PSH, MANIFEST),
+        WV3_MUL: mf.file_hash(WV3_MUL, MANIFEST)
+    }
+
+    # Indices which can be computed with the image bands
+    indices_mtd = {
+        k: v for k, v in spin.load_indices().items()
+        if spin.check_bands(bands_key, v['bands'])
+    }
+    index_passes = spin.plan_indices(indices_mtd, WV3_PSH, bands_pos, bands_key, INDICES_DIR, WV3_MUL)
+
     # NOTE: PCA will be executed both, with pansharpen imagen (7 bands) and with original image (8 bands)
     tasks = [
         {
             'folder': "PCA120cm",
+            'tag': "120cm",
             'image_path': WV3_MUL,
             'bands': ["C", "B", "G", "Y", "R", "RE", "N1", "N2"]
         },
         {
             'folder': "PCA31cm",
+            'tag': "30cm",
             'image_path': WV3_PSH,
             'bands': ["C", "B", "G", "Y", "R", "RE", "N1"]
         }
     ]
     for task in tasks:
-        OUTPUT_DIR = os.path.join(ROOT, f'neochannels/{image_name}/{task["folder"]}')
+        task['output_dir'] = os.path.join(ROOT, f'neochannels/{image_name}/{task["folder"]}')
         cf.createDir(ROOT, f'neochannels/{image_name}/{task["folder"]}')
-    
+        task['combis'] = pca.combis(task['bands'], 3, task['output_dir'])
+        task['moments'] = None
+        if PCA_TOP_K is None and PCA_MIN_EXPLAINED is None:
+            continue
 
-        combis_dict = pca.combis(task['bands'], 3, OUTPUT_DIR)
+        # Ranking fingerprint: image, bands and selection parameters. The
+        # moments are only computed when the ranking is stale, otherwise
+        # when some combination is stale (see write_pca)
+        stage = 'rank_' + task['folder']
+        key = mf.fingerprint(
+            'rank', img_hashes[task['image_path']], task['bands'], pca.N_PC, PCA_ESTIMATOR,
+            PCA_SAMPLE_FRACTION, PCA_TOP_K, PCA_MIN_EXPLAINED
+        )
+        ranking_path = os.path.join(task['output_dir'], 'pca_band_ranking.csv')
+        if INCREMENTAL and mf.is_fresh(MANIFEST, stage, key, [ranking_path]):
+            selected = pca.read_ranking(task['combis'], task['output_dir'])
+            if selected is not None:
+                task['combis'] = selected
+                continue
+
+        # Rank the combinations from the matrix of all bands
+        task['moments'] = pca.band_moments(
+            task['image_path'], list(range(1, len(task['bands']) + 1)),
+            sample_fraction = PCA_SAMPLE_FRACTION
+        )
+        task['combis'] = pca.rank_combis(
+            task['moments'], task['combis'], task['bands'], task['output_dir'],
+            estimator_matrix = PCA_ESTIMATOR, top_k = PCA_TOP_K, min_explained = PCA_MIN_EXPLAINED
+        )
+        mf.record(MANIFEST, stage, key, [ranking_path])
+
+    stacks = None
+    if STACKED_OUTPUT:
+        # Create one stack by resolution with all its neochannels
+        stacks = {}
+        for task in tasks:
+            stack_bands = {}
+            for p in index_passes:
+                if p['tag'] == task['tag']:
+                    stack_bands.update(spin.stack_bands(p))
+            stack_bands.update(pca.stack_bands(task['combis'], task['bands'], task['folder']))
 
-        for combi_id, combi_bands in combis_dict.items():
-            # Create PCA image
-            print(f"\nWriting PCA from combi {combi_id} bands\n")
-            print(f"==========================================\n")
             name = os.path.basename(task['image_path']).split('.')[0]
-            out_name = '_'.join([name, task['folder'], 'C' + str(combi_id)])
-            img_out_path = os.path.join(OUTPUT_DIR, out_name + '.tif')
-            eigenvals, eigenvectors = pca.compute_pca(task['image_path'], combi_bands, img_out_path)
-            # Write stats
-            out_stats = os.path.join(OUTPUT_DIR, out_name +'_stats.csv')
-            pca.write_stats(eigenvals, eigenvectors, out_stats, "csv")
+            extension = '.tif' if STACK_FORMAT == "GTiff" else '.zarr'
+            task['stack_path'] = os.path.join(ROOT, f'neochannels/{image_name}', name + '_neochannels' + extension)
+            print(f"..Create stack with {len(stack_bands)} bands: {task['stack_path']}\n")
+            stacks[task['tag']] = rb.create_stack(task['stack_path'], task['image_path'], stack_bands, STACK_FORMAT)
+
+    print("==== SPECTRAL INDICES (WV3 image) ====\n")
+    # Index fingerprint: images, formula and band mapping of every pass
+    index_keys = {}
+    index_outputs = {}
+    for index_key in indices_mtd:
+        index_inputs = []
+        index_outputs[index_key] = []
+        for p in index_passes:
+            if index_key in p['indices']:
+                index_inputs.append([p['tag'], img_hashes[p['img_path']], p['band_positions']])
+                index_outputs[index_key].append(p['out_paths'][index_key])
+        index_keys[index_key] = mf.fingerprint(
+            'index', indices_mtd[index_key]['formula'], indices_mtd[index_key]['bands'], index_inputs
+        )
+    stale_indices = [
+        k for k in indices_mtd
+        if not (incremental and mf.is_fresh(MANIFEST, 'index_' + k, index_keys[k], index_outputs[k]))
+    ]
+    print(f"..Indices up to date: {len(indices_mtd) - len(stale_indices)} of {len(indices_mtd)}\n")
+
+    if len(stale_indices) > 0:
+        spin.compute_all_indices(
+            WV3_PSH, bands_pos, bands_key, INDICES_DIR, img_120cm_path = WV3_MUL,
+            all = stale_indices, workers = WORKERS, stacks = stacks
+        )
+        if not STACKED_OUTPUT:
+            for index_key in stale_indices:
+                mf.record(MANIFEST, 'index_' + index_key, index_keys[index_key], index_outputs[index_key])
+
+    print("==== PCA (WV3 image) ====\n")
+    for task in tasks:
+        write_pca(task, img_hashes[task['image_path']], stacks[task['tag']] if STACKED_OUTPUT else None)
+
+    if STACKED_OUTPUT:
+        for task in tasks:
+            stacks[task['tag']].FlushCache()
+        # Close the stacks before computing their pyramids (write_pca and
+        # compute_all_indices do not keep any reference to them)
+        stacks = None
+        if STACK_FORMAT == "GTiff":
+            # compute the pyramids for the stacks
+            rb.build_overviews([task['stack_path'] for task in tasks], WORKERS)
 
 elif len(CORONA) > 0:
     print('==== CORONA HIGH PASS FILTER ====\n')
     image_name = os.path.basename(CORONA).split('.')[0]
     OUTPUT_DIR = os.path.join(ROOT, f'neochannels/{image_name}')
     cf.createDir(ROOT, f'neochannels/{image_name}')
-    output = os.path.join(OUTPUT_DIR, image_name + '_focal.tif')
-    hpf.focal(CORONA, output)
\ No newline at end of file
+    MANIFEST = mf.load_manifest(OUTPUT_DIR)
+    if FOCAL_BANK is None:
+        stage = 'focal'
+        output = os.path.join(OUTPUT_DIR, image_name + '_focal.tif')
+        key = mf.fingerprint('focal', mf.file_hash(CORONA, MANIFEST))
+    else:
+        stage = 'focal_bank'
+        output = os.path.join(OUTPUT_DIR, image_name + '_focal_bank.tif')
+        key = mf.fingerprint('focal_bank', mf.file_hash(CORONA, MANIFEST), FOCAL_BANK)
+
+    if INCREMENTAL and mf.is_fresh(MANIFEST, stage, key, [output]):
+        print("..Skip high pass filter: inputs did not change\n")
+    else:
+        if FOCAL_BANK is None:
+            hpf.focal(CORONA, output, workers = WORKERS)
+        else:
+            hpf.focal_bank(CORONA, output, FOCAL_BANK, workers = WORKERS)
+        mf.record(MANIFEST, stage, key, [output])
\ No newline at end of file
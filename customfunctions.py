@@ -10,7 +10,10 @@ import csv
 from datetime import datetime
 import string
 import subprocess
+import numpy as np
 from Py6S import * # 6S python module
+import rasterblocks as rb
+import sixscache as cs
 
 # Earth engine modules
 import ee
@@ -21,23 +24,36 @@ import collections
 
 RADIOMETRIC_USE = "D:/arqueologia-proceso-copiaseguridad/codigo-zenodo/wv3-radiometric-use.csv"
 
-def translate(resx, resy, input_path, output_path):
+# Creation options of the pretreated images by output format (VRT files
+# are only an XML description read on the fly)
+PRETREATMENT_OPTIONS = {
+    'GTiff': '-co COMPRESS=DEFLATE -co PREDICTOR=2',
+    'VRT': ''
+}
+
+def translate(resx, resy, input_path, output_path, output_format: str = "GTiff"):
 
     """
     Use gdal_translate to convert image from TIL to TIF
     extension.
 
+    With output_format VRT nothing is written but a virtual dataset. The
+    next step (radiometric correction) reads the TIL tiles through it.
+
     :resx: Number of pixels in X axis
     :resy: Number of pixels in Y axis
     :input_path: Input image src
     :output_path: Output image src
+    :output_format: GTiff | VRT
     """
+    if output_format not in PRETREATMENT_OPTIONS:
+        raise ValueError("The 'output_format' parameter is not valid.")
 
     gdal_translate = [
         'gdal_translate',
-        '-of GTiff',
+        f'-of {output_format}',
         '-ot UInt16',
-        '-co COMPRESS=DEFLATE -co PREDICTOR=2',
+        PRETREATMENT_OPTIONS[output_format],
         '-tr {resx} -{resy}',
         '-a_nodata 0 "{img_input}" "{img_output}"'
     ]
@@ -52,17 +68,24 @@ def translate(resx, resy, input_path, output_path):
     output = subprocess.check_output(command, shell=True)
     return [command, output]
 
-def clip(resx, resy, aoi, input_path, output_path):
+def clip(resx, resy, aoi, input_path, output_path, output_format: str = "GTiff"):
 
     """
     Use gdalwarp tool to clip the image by aoi limits.
 
+    With output_format VRT nothing is written but a warped virtual
+    dataset, so the cubicspline resampling and the cutline are computed
+    while the next step (radiometric correction) reads it.
+
     :resx: Number of pixels in X axis
     :resy: Number of pixels in Y axis
     :aoi: geoJSON with polyline to use as clip mask
     :input_path: Input image src
     :output_path: Output image src
+    :output_format: GTiff | VRT
     """
+    if output_format not in PRETREATMENT_OPTIONS:
+        raise ValueError("The 'output_format' parameter is not valid.")
 
     if (not os.path.exists(aoi)):
         errmsg = (
@@ -73,9 +96,9 @@ def clip(resx, resy, aoi, input_path, output_path):
 
     gdal_warp = [
         'gdalwarp',
-        '-of GTiff',
+        f'-of {output_format}',
         '-ot UInt16',
-        '-co COMPRESS=DEFLATE -co PREDICTOR=2',
+        PRETREATMENT_OPTIONS[output_format],
         '-tr {resx} -{resy} -r cubicspline',
         '-overwrite',
         '-dstnodata 0',
@@ -292,19 +315,38 @@ def ARC(input_image, output_image, imd: dict):
     output = calc(formulas, bands, b_number, output_image)
     return(output)
 
-def sixs(input_image, output_image, xml, gee_credentials, service_account, imd):
+def arc_coefficients(imd: dict) -> list:
     """
-    Formula: REF(BOA) = pi * (L - Lp) / t * ( Edir + Edif )
+    Gain and offset of the AbsoluteRadiometricCorrection by band
+    ============================================================
 
-    Lp = Path radiance
-    t = transmissivity (absorption transmissivity (TAUv?) * scattering transmissivity (TAUz?))
-    Edir = Direct Solar Irradiance (Eo?)
-    Edif = Diffuse solar irradiance (Edown?)
-    * Terms follow by ? are the closest approx to 6S formula terms (from Sam
-    Murphy repo) in Chavez 1996 radiance to BOA reflectance function.
+    Formula: L = GAIN * DN * ( abscalfactor / effectivebandwith ) + OFFSET
+    i.e. L = gain * DN + offset with gain = GAIN * abscalfactor / effectivebandwith
+
+    :imd: IMD image metadata transformed in a dict.
+    return list with a dict (band, gain, offset) by image band.
+    """
+    coefficients = []
+    for band in get_band_keys(imd):
+        # Return global metadata by band
+        gm = get_csv_row(band, 'bandas', RADIOMETRIC_USE)
+        # Return image metadata by band
+        band_metadata = imd['BAND_'+band]
+        absCalFactor = float(band_metadata['absCalFactor'])
+        effectiveBandwidth = float(band_metadata['effectiveBandwidth'])
+
+        coefficients.append({
+            'band': band,
+            'gain': float(gm['GAIN_2015v2']) * absCalFactor / effectiveBandwidth,
+            'offset': float(gm['OFFSET_2015v2'])
+        })
+    return coefficients
+
+def sixs_inputs(xml, gee_credentials, service_account, imd) -> dict:
+    """
+    Retrieve the 6S scene parameters (geometry, atmospheric constituents
+    and altitudes) from the image metadata and Google Earth Engine.
 
-    :input_image: Path from the image to transform
-    :output_image: Path to store the atmospheric corrected image
     :xml: Global image metadata in XML (parsed xml)
     :gee_credentials: GEE PRIVATE API KEY
     :service_account: Email from private API key
@@ -326,25 +368,6 @@ def sixs(input_image, output_image, xml, gee_credentials, service_account, imd):
     # Get center point
     geom = footprint.centroid()
 
-    """
-    6S object
-
-    The backbone of Py6S is the 6S (i.e. SixS) class. It allows you to define the
-    various input parameters, to run the radiative transfer code and to access
-    the outputs which are required to convert radiance to surface reflectance.
-    """
-    # Instantiate
-    s = SixS()
-
-    """
-    Geometric conditions
-
-    - Month
-    - Day
-    - Sun zenith and azimuth angles
-    - Sensor/View zenith and azimuth angles
-    """
-    s.geometry = Geometry.User()
     # Date
     strDate = imd['MAP_PROJECTED_PRODUCT']['earliestAcqTime']
     # Convert a string with UTC date to python datetime
@@ -352,18 +375,6 @@ def sixs(input_image, output_image, xml, gee_credentials, service_account, imd):
         strDate,
         "%Y-%m-%dT%H:%M:%S.%fZ"
     )
-    s.geometry.month = date.month # Month (used for Earth-Sun distance)
-    s.geometry.day = date.day     # Day (used for Earth-Sun distance)
-    
-    # Sensor zenith angle (NADIR)
-    s.geometry.view_z = 0
-    # Sensor azimuth angle
-    s.geometry.view_a = float(imd['IMAGE_1']['meanSatAz'])
-    # Solar zenith angle
-    solar_z = round(90 - float(imd['IMAGE_1']['meanSunEl']), 2) 
-    s.geometry.solar_z = solar_z
-    # Solar azimuth angle
-    s.geometry.solar_a = float(imd['IMAGE_1']['meanSunAz'])
 
     """
     Atmospheric profile and Aerosol Profile
@@ -371,33 +382,67 @@ def sixs(input_image, output_image, xml, gee_credentials, service_account, imd):
     * Import manually the atmospheric constitutients
     * AOT at 550nm
     """
-    # Atmospheric constituents
-    date = ee.Date(str(date.year)+"-"+str(date.month)+"-"+str(date.day))
-    h2o = Atmospheric.water(geom,date).getInfo()
-    o3 = Atmospheric.ozone(geom,date).getInfo()
-    aot = Atmospheric.aerosol(geom,date).getInfo()
+    ee_date = ee.Date(str(date.year)+"-"+str(date.month)+"-"+str(date.day))
+    h2o = Atmospheric.water(geom,ee_date).getInfo()
+    o3 = Atmospheric.ozone(geom,ee_date).getInfo()
+    aot = Atmospheric.aerosol(geom,ee_date).getInfo()
 
-    # Atmospheric constituents
-    s.atmos_profile = AtmosProfile.UserWaterAndOzone(h2o,o3)
-    # s.aero_profile = AeroProfile.Continental
-    s.aero_profile = AeroProfile.Desert
-    s.aot550 = aot
-
-    """
-    Altitudes
-
-    Allows the specification of target and sensor altitudes.
-    """
     # Altitude - Shuttle Radar Topography mission (covers *most* of the Earth)
     SRTM = ee.Image('CGIAR/SRTM90_V4') 
     alt = SRTM.reduceRegion(
         reducer = ee.Reducer.mean(),
         geometry = geom.centroid()
     ).get('elevation').getInfo()
-    km = alt/1000 # i.e. Py6S uses units of kilometers
-    s.altitudes.set_target_custom_altitude(km)
-    sensor_altitude = float(imd['IMAGE_1']['meanSatEl'])
-    s.altitudes.set_sensor_custom_altitude(sensor_altitude)
+
+    return {
+        'month': date.month,                                  # Earth-Sun distance
+        'day': date.day,
+        'view_z': 0,                                          # Sensor zenith angle (NADIR)
+        'view_a': float(imd['IMAGE_1']['meanSatAz']),         # Sensor azimuth angle
+        'solar_z': round(90 - float(imd['IMAGE_1']['meanSunEl']), 2),
+        'solar_a': float(imd['IMAGE_1']['meanSunAz']),
+        'h2o': h2o,
+        'o3': o3,
+        'aot': aot,
+        'target_km': alt/1000,                                # Py6S uses kilometers
+        'sensor_altitude': float(imd['IMAGE_1']['meanSatEl'])
+    }
+
+def run_sixs(params: dict, lowerWav: float, upperWav: float) -> dict:
+    """
+    Run 6S for one waveband and extract the outputs used to compute the
+    surface reflectance.
+
+    The backbone of Py6S is the 6S (i.e. SixS) class. It allows you to define the
+    various input parameters, to run the radiative transfer code and to access
+    the outputs which are required to convert radiance to surface reflectance.
+
+    :params: Scene parameters returned by sixs_inputs()
+    :lowerWav: Start band wavelength (micrometers)
+    :upperWav: End band wavelength (micrometers)
+    return dict with Lp, tau2, Edir and Edif
+    """
+    # Instantiate
+    s = SixS()
+
+    # Geometric conditions
+    s.geometry = Geometry.User()
+    s.geometry.month = params['month']
+    s.geometry.day = params['day']
+    s.geometry.view_z = params['view_z']
+    s.geometry.view_a = params['view_a']
+    s.geometry.solar_z = params['solar_z']
+    s.geometry.solar_a = params['solar_a']
+
+    # Atmospheric constituents
+    s.atmos_profile = AtmosProfile.UserWaterAndOzone(params['h2o'], params['o3'])
+    # s.aero_profile = AeroProfile.Continental
+    s.aero_profile = AeroProfile.Desert
+    s.aot550 = params['aot']
+
+    # Altitudes
+    s.altitudes.set_target_custom_altitude(params['target_km'])
+    s.altitudes.set_sensor_custom_altitude(params['sensor_altitude'])
 
     """
     Wavelenght conditions
@@ -411,62 +456,253 @@ def sixs(input_image, output_image, xml, gee_credentials, service_account, imd):
     https://dg-cms-uploads-production.s3.amazonaws.com/uploads/document/file/105/DigitalGlobe_Spectral_Response_1.pdf
 
     """
-    # Get WV3 image bands
-    wv_bands = get_band_keys(imd)
-    # Return formula to compute ARC BY BAND
+    s.wavelength = Wavelength(lowerWav, upperWav)
+
+    # run 6S for this waveband
+    s.run()
+
+    # extract 6S outputs
+    absorb  = s.outputs.trans['global_gas'].upward       #absorption transmissivity
+    scatter = s.outputs.trans['total_scattering'].upward #scattering transmissivity
+    return {
+        'Lp': s.outputs.atmospheric_intrinsic_radiance,     #path radiance
+        'tau2': absorb*scatter,                             #total transmissivity
+        'Edir': s.outputs.direct_solar_irradiance,          #direct solar irradiance
+        'Edif': s.outputs.diffuse_solar_irradiance          #diffuse solar irradiance
+    }
+
+def sixs_band(task: tuple) -> dict:
+    """
+    Run 6S for one band (worker function). Each call configures its own
+    SixS instance, so several bands can run at the same time.
+
+    :task: Tuple (params, band, lowerWav, upperWav, cache_dir). With a
+    cache_dir the outputs come from the 6S cache when possible (see
+    sixscache.coefficients).
+    return dict with band, Lp, tau2, Edir and Edif
+    """
+    params, band, lowerWav, upperWav, cache_dir = task
+    if cache_dir:
+        band_coefficients = cs.coefficients(run_sixs, params, lowerWav, upperWav, cache_dir)
+    else:
+        band_coefficients = run_sixs(params, lowerWav, upperWav)
+    band_coefficients['band'] = band
+    print(f"....Band {band} Path radiance: {band_coefficients['Lp']}")
+    return band_coefficients
+
+def sixs_coefficients(xml, gee_credentials, service_account, imd,
+workers: int = 1, pool: str = "thread", cache_dir: str = None) -> list:
+    """
+    Run 6S for each image band.
+
+    Every 6S run launches the external 6S executable and waits for it, so
+    the bands are run at the same time by a pool of workers.
+
+    :xml: Global image metadata in XML (parsed xml)
+    :gee_credentials: GEE PRIVATE API KEY
+    :service_account: Email from private API key
+    :imd: IMD image metadata transformed in a dict.
+    :workers: Number of 6S runs at the same time
+    :pool: thread | process
+    :cache_dir: Folder of the 6S cache (see sixscache). None to always
+    run 6S.
+    return list with a dict (band, Lp, tau2, Edir, Edif) by image band.
+    """
+    params = sixs_inputs(xml, gee_credentials, service_account, imd)
+
+    tasks = []
+    for band in get_band_keys(imd):
+        gm = get_csv_row(band, 'bandas', RADIOMETRIC_USE) 
+        tasks.append((
+            params, band, float(gm['lowerBandEdge']), float(gm['upperBandEdge']), cache_dir
+        ))
+    return list(rb.map_windows(sixs_band, tasks, workers, pool))
+
+def lut_band(task: tuple) -> str:
+    """
+    Build the 6S LUT of one band (worker function).
+
+    :task: Tuple (params, lowerWav, upperWav, cache_dir, grid)
+    return LUT file path or None if a stored LUT already covers the band.
+    """
+    params, lowerWav, upperWav, cache_dir, grid = task
+    if cs.lut_lookup(params, lowerWav, upperWav, cache_dir) is not None:
+        return None
+    return cs.build_lut(
+        run_sixs, params, lowerWav, upperWav, cache_dir,
+        grid['solar_z'], grid['aot'], grid['h2o']
+    )
+
+def sixs_luts(xml, gee_credentials, service_account, imd, cache_dir: str, grid: dict,
+workers: int = 1, pool: str = "thread") -> list:
+    """
+    Precompute the 6S LUTs of each image band around the image scene
+    parameters. The next scenes of the same site and season are then
+    interpolated instead of running 6S (see sixscache.lut_lookup). The
+    bands already covered by a stored LUT are skipped.
+
+    :xml: Global image metadata in XML (parsed xml)
+    :gee_credentials: GEE PRIVATE API KEY
+    :service_account: Email from private API key
+    :imd: IMD image metadata transformed in a dict.
+    :cache_dir: Folder of the 6S cache.
+    :grid: Dict with the increasing values (at least two) of each LUT
+    axis: solar_z, aot and h2o.
+    :workers: Number of bands computed at the same time
+    :pool: thread | process
+    return list with the LUT paths (None for the skipped bands).
+    """
+    params = sixs_inputs(xml, gee_credentials, service_account, imd)
+
+    tasks = []
+    for band in get_band_keys(imd):
+        gm = get_csv_row(band, 'bandas', RADIOMETRIC_USE) 
+        tasks.append((
+            params, float(gm['lowerBandEdge']), float(gm['upperBandEdge']), cache_dir, grid
+        ))
+    return list(rb.map_windows(lut_band, tasks, workers, pool))
+
+def write_coefficients(arc: list, sixs: list, output_path: str):
+    """
+    Write the ARC and 6S coefficients of each band in a csv table.
+
+    :arc: List returned by arc_coefficients()
+    :sixs: List returned by sixs_coefficients()
+    :output_path: csv file path
+    """
+    columns = ['band', 'gain', 'offset', 'Lp', 'tau2', 'Edir', 'Edif']
+    with open(output_path, 'w', newline='') as file:
+        csvWriter = csv.DictWriter(file, fieldnames=columns, quoting=csv.QUOTE_NONNUMERIC)
+        csvWriter.writeheader()
+        for a, c in zip(arc, sixs):
+            csvWriter.writerow({**a, **c})
+
+def sixs(input_image, output_image, xml, gee_credentials, service_account, imd):
+    """
+    Formula: REF(BOA) = pi * (L - Lp) / t * ( Edir + Edif )
+
+    Lp = Path radiance
+    t = transmissivity (absorption transmissivity (TAUv?) * scattering transmissivity (TAUz?))
+    Edir = Direct Solar Irradiance (Eo?)
+    Edif = Diffuse solar irradiance (Edown?)
+    * Terms follow by ? are the closest approx to 6S formula terms (from Sam
+    Murphy repo) in Chavez 1996 radiance to BOA reflectance function.
+
+    :input_image: Path from the image to transform
+    :output_image: Path to store the atmospheric corrected image
+    :xml: Global image metadata in XML (parsed xml)
+    :gee_credentials: GEE PRIVATE API KEY
+    :service_account: Email from private API key
+    :imd: IMD image metadata transformed in a dict.
+    """
+    coefficients = sixs_coefficients(xml, gee_credentials, service_account, imd)
+
+    # Return formula to compute 6S BY BAND
     formulas = []
     # Return bands
     bands = []
     # Return band number
     b_number = []
-    for i in range(0, len(wv_bands)):
-        band = wv_bands[i]
+    for i, c in enumerate(coefficients):
         # Assign a letter to each band
         band_letter = list(string.ascii_uppercase)[i]
 
-        gm = get_csv_row(band, 'bandas', RADIOMETRIC_USE) 
-        lowerWav = float(gm['lowerBandEdge'])
-        upperWav = float(gm['upperBandEdge'])
-
-        s.wavelength = Wavelength(lowerWav, upperWav)
-
-        # print(
-        #     "6S inputs:\n"+
-        #     f"- H2O: {h2o}\n"
-        #     f"- O3: {o3}\n"
-        #     f"- AOT: {aot}\n"
-        #     f"- Altitude: {km}\n"
-        #     f"- Solar zenith angle: {solar_z}\n"
-        # )
-    
-        # run 6S for this waveband
-        s.run()
-
-        # extract 6S outputs
-        Edir = s.outputs.direct_solar_irradiance             #direct solar irradiance
-        Edif = s.outputs.diffuse_solar_irradiance            #diffuse solar irradiance
-        Lp   = s.outputs.atmospheric_intrinsic_radiance      #path radiance
-        absorb  = s.outputs.trans['global_gas'].upward       #absorption transmissivity
-        scatter = s.outputs.trans['total_scattering'].upward #scattering transmissivity
-        tau2 = absorb*scatter                                #total transmissivity
-
-        # print(f"Solar zenith angle: {solar_z}, Altitude (km): {km}, % Water Vapour: {h2o}, Ozone: {o3}, AOT: {aot}")
-        # print(f"Band {band} Path radiance: {Lp}")
-        
         # Compute surface reflectance formula
-        f = f'(pi*({band_letter} - {Lp}))/({tau2}*({Edir}+{Edif}))'
+        f = f"(pi*({band_letter} - {c['Lp']}))/({c['tau2']}*({c['Edir']}+{c['Edif']}))"
         formulas.append('--calc="' + f + '"')
 
         # Match input band and its letter (the image is the same)
         b = f'-{band_letter} "{input_image}"'
         bands.append(b)
         # Custom band number
-        n = f'--{band_letter}_band={wv_bands.index(band)+1}'
+        n = f'--{band_letter}_band={i+1}'
         b_number.append(n)
 
     # Perform 6S
     output = calc(formulas, bands, b_number, output_image)
     return(output)
+
+def correct_window(task: tuple) -> tuple:
+    """
+    ARC and 6S correction of one image window (worker function).
+
+    :task: Tuple (input_image, window, arc, sixs, with_radiance)
+    return (window, reflectance bands, radiance bands or None)
+    """
+    input_image, window, arc, sixs, with_radiance = task
+    src_ds = rb.open_dataset(input_image)
+
+    # ARC (radiance). As gdal_calc, a pixel is nodata in every band when
+    # it is nodata (0) in any DN band or in any radiance band
+    radiance = []
+    nodata_mask = None
+    for i, a in enumerate(arc):
+        dn, mask = rb.read_window(src_ds, i + 1, window)
+        L = np.abs(a['gain'] * dn + a['offset'])
+        band_mask = L == 0
+        if mask is not None:
+            band_mask |= mask
+        nodata_mask = band_mask if nodata_mask is None else nodata_mask | band_mask
+        radiance.append(L)
+
+    # 6S (surface reflectance)
+    reflectance = []
+    for L, c in zip(radiance, sixs):
+        ref = np.pi * (L - c['Lp']) / (c['tau2'] * (c['Edir'] + c['Edif']))
+        ref[nodata_mask] = 0
+        reflectance.append(ref.astype(np.float32))
+
+    if not with_radiance:
+        return window, reflectance, None
+    for i, L in enumerate(radiance):
+        L[nodata_mask] = 0
+        radiance[i] = L.astype(np.float32)
+    return window, reflectance, radiance
+
+def radiometric_correction(input_image, output_image, arc: list, sixs: list,
+arc_image = None, workers: int = 1):
+    """
+    Compute the ARC and the 6S correction in one streaming pass, from the
+    DN image to surface reflectance. It gives the same result as ARC()
+    followed by sixs() without writing the ARC image: a pixel which is
+    nodata in any band is nodata in all the output bands.
+
+    Formula: L = abs( gain * DN + offset )
+             REF(BOA) = pi * (L - Lp) / t * ( Edir + Edif )
+
+    :input_image: Path from the image to transform (DN)
+    :output_image: Path to store the surface reflectance image
+    :arc: List returned by arc_coefficients()
+    :sixs: List returned by sixs_coefficients()
+    :arc_image: Path to store the radiance image too (optional, to debug)
+    :workers: Number of windows corrected at the same time
+    """
+    src_ds = rb.open_raster(input_image)
+    if not (src_ds.RasterCount == len(arc) == len(sixs)):
+        raise ValueError("The image bands do not match the ARC and 6S coefficients.")
+
+    options = ['COMPRESS=DEFLATE', 'PREDICTOR=2']
+    out_imgs = [rb.create_output(output_image, src_ds, len(arc), options=options)]
+    if arc_image is not None:
+        out_imgs.append(rb.create_output(arc_image, src_ds, len(arc), options=options))
+    for out_img in out_imgs:
+        for b in range(1, len(arc) + 1):
+            out_img.GetRasterBand(b).SetNoDataValue(0)
+
+    tasks = [
+        (input_image, window, arc, sixs, arc_image is not None)
+        for window in rb.block_windows(src_ds)
+    ]
+    for window, reflectance, radiance in rb.map_windows(correct_window, tasks, workers, "thread"):
+        for b, arr in enumerate(reflectance):
+            out_imgs[0].GetRasterBand(b + 1).WriteArray(arr, window[0], window[1])
+        if radiance is not None:
+            for b, arr in enumerate(radiance):
+                out_imgs[1].GetRasterBand(b + 1).WriteArray(arr, window[0], window[1])
+
+    for out_img in out_imgs:
+        out_img.FlushCache()
+    del out_imgs, src_ds
     
 def wBrovey(mul: str, pan: str, output_image: str):
     """
@@ -1,27 +1,35 @@
 import os
 from osgeo import gdal
-from multiprocessing.pool import ThreadPool
 import numpy as np
-import dask
-from dask import array as da
-from scipy import ndimage
+import rasterblocks as rb
+
+# Creation options of the filtered images (tiled BigTIFF when it is needed)
+CREATION_OPTIONS = [
+    'TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256',
+    'COMPRESS=DEFLATE', 'PREDICTOR=3', 'BIGTIFF=IF_SAFER'
+]
+
+# Default filter bank: (filter, kernel size). Filters:
+# - highpass: center pixel minus the local mean
+# - contrast: center pixel minus the local mean divided by the local
+#   standard deviation
+FILTER_BANK = [('highpass', 3), ('highpass', 5), ('highpass', 9), ('highpass', 15)]
 
 # Save raster image as numpy array
 def read_raster(path: str):
     """
-    Parse raster as numpy array with raster dimensions.
+    Parse raster as a lazy dask array with raster dimensions.
     Important: The nodata value will be replaced as
     numpy.nan data.
     Important: The default datatype is float32
+    Important: Nothing is read until the array is computed, and then
+    only the chunks (aligned to the file blocks) that are needed
+    (see rasterblocks.lazy_raster).
     Example: Raster with 5 bands, 30 rows and 25 columns
     generates an array with shape (5,30,30).
     :path: Dirpath with image to read.
     return the array with the image and its properties.
     """
-    # init dask as threads (shared memory is required)
-    dask.config.set(pool=ThreadPool(1))
-
-    raw_image = []
     src_ds = gdal.Open(str(path), gdal.GA_ReadOnly)
     n_bands = src_ds.RasterCount
 
@@ -30,24 +38,15 @@ def read_raster(path: str):
 
     print("..Read raster")
     nodata = None
-    # Write each band in a numpy array
     for band in range(1,n_bands + 1):
-        # Transform image band into numpy array
-        ds = src_ds.GetRasterBand(band).ReadAsArray().astype(np.float32)
-
         nodata_value = src_ds.GetRasterBand(band).GetNoDataValue()
         if nodata is None:
             nodata = nodata_value
         elif nodata != nodata_value:
             raise ValueError("Image nodata value must be equal in all bands.")
         print(f"....Band {band} nodata value: {nodata}")
-        # Fill nodata values with NaN
-        ds[ds == nodata] = np.nan
-        # Add band to a list
-        raw_image.append(ds)
 
-    # Merge each dimension (bands) in n dimension array (n = number of bands)
-    raw_image_np = da.stack(raw_image).rechunk(('auto'))
+    raw_image_np = rb.lazy_raster(path)
     return (raw_image_np, projection, geoTrans, nodata)
 
 def get_bbox(path: str) -> dict:
@@ -76,76 +75,231 @@ def get_bbox(path: str) -> dict:
     bbox = [ulx,lry,lrx, uly, resX, resY]
     return bbox
 
-def high_pass_filter(array):
+def integral_image(band):
+    """
+    Compute the integral images (summed-area tables) of a band and of its
+    NaN mask. Any box sum is then obtained with 4 lookups.
+    :band: 2D Numpy array with format (rows,columns)
+    return (values, nans) with shape (rows + 1, columns + 1)
+    """
+    band = np.asarray(band, dtype=np.float64)
+    nan_mask = np.isnan(band)
+
+    values = np.zeros((band.shape[0] + 1, band.shape[1] + 1))
+    values[1:, 1:] = np.where(nan_mask, 0, band).cumsum(axis=0).cumsum(axis=1)
+    nans = np.zeros(values.shape, dtype=np.int64)
+    nans[1:, 1:] = nan_mask.cumsum(axis=0).cumsum(axis=1)
+    return values, nans
+
+def box_sum(integral: tuple, size: int):
+    """
+    Sum of the size x size neighbourhood of every pixel.
+
+    The sum is NaN if the neighbourhood contains any NaN or it exceeds
+    the band borders (as a convolution filled with NaN outside).
+    :integral: Tuple returned by integral_image()
+    :size: Odd neighbourhood size (e.g. 5)
+    return 2D Numpy array (float64) with the band shape
+    """
+    if size < 1 or size % 2 == 0:
+        raise ValueError("The kernel size must be an odd number.")
+
+    values, nans = integral
+    rows = values.shape[0] - 1
+    columns = values.shape[1] - 1
+    sums = np.full((rows, columns), np.nan)
+    if rows < size or columns < size:
+        return sums
+
+    def window_sum(table):
+        return table[size:, size:] - table[:-size, size:] - table[size:, :-size] + table[:-size, :-size]
+
+    radius = size // 2
+    interior = window_sum(values)
+    interior[window_sum(nans) > 0] = np.nan
+    sums[radius:rows - radius, radius:columns - radius] = interior
+    return sums
+
+def high_pass_band(band, size: int = 5, integral: tuple = None):
+    """
+    High pass filter of one band: the center pixel weighted with
+    size * size - 1 minus its neighbours, divided by size * size
+    (the 5x5 kernel is the Gangkofner et al., 2007 weight matrix).
+    :band: 2D Numpy array with format (rows,columns)
+    :size: Odd kernel size
+    :integral: Tuple returned by integral_image() (computed if None)
     """
-    Obtain a numpy array with convolve mul image
+    if integral is None:
+        integral = integral_image(band)
+    n = size * size
+    return ((n * np.asarray(band, dtype=np.float64) - box_sum(integral, size)) / n).astype(np.float32)
+
+def high_pass_filter(array, size: int = 5):
+    """
+    Obtain a numpy array with the high pass filter of each band.
+
+    The kernel is applied to each band alone with box sums, so the cost
+    per pixel does not depend on the kernel size. The pixels near a NaN
+    or near the image borders are NaN.
     :array: 3D Numpy array with format (n_bands,rows,columns)
+    :size: Odd kernel size (5 by default)
     """
-    # Create high pass filter to extract spatial component
-    # 5x5 Weight matrix (Gangkofner et al., 2007)
-    highPassMatrix = np.array([
-        [-1, -1, -1,-1, -1],
-        [-1, -1, -1,-1, -1],
-        [-1, -1, 24, -1, -1],
-        [-1, -1, -1,-1, -1],
-        [-1, -1, -1,-1, -1],
-    ]) / 25
+    return np.stack([high_pass_band(band, size) for band in np.asarray(array)])
 
-    # Kernel in 3D (repeat kernel for each image band)
-    # The convolve function only works if kernel shape is equal
-    # array shape.
-    k = []
+def read_halo(image: str, band: int, window: tuple, radius: int):
+    """
+    Read a full width window plus `radius` rows above and below it. The
+    rows outside the image and the nodata pixels are NaN.
+    :image: Image path
+    :band: Band number (starting from 1)
+    :window: Tuple (xoff, yoff, xsize, ysize)
+    :radius: Halo size (rows)
+    """
+    src_ds = rb.open_dataset(image)
+    xoff, yoff, xsize, ysize = window
+    top = max(0, yoff - radius)
+    bottom = min(src_ds.RasterYSize, yoff + ysize + radius)
 
-    for b in range(0,array.shape[0]):
-        k.append(highPassMatrix)
-    k = np.stack(k)
+    arr, mask = rb.read_window(src_ds, band, (xoff, top, xsize, bottom - top))
+    if mask is not None:
+        arr[mask] = np.nan
 
-    # Apply convolve automatically with scipy
-    convolve_image = ndimage.convolve(array,k,mode='constant',cval=np.nan)
-    return convolve_image
+    halo = np.full((ysize + 2 * radius, xsize), np.nan, dtype=np.float32)
+    start = top - (yoff - radius)
+    halo[start:start + arr.shape[0]] = arr
+    return halo
 
-def focal(image: str, output_path: str):
+def filter_bank(band, filters: list) -> list:
+    """
+    Apply several filters (and kernel sizes) to one band. The integral
+    images are computed once and shared by all the filters.
+    :band: 2D Numpy array with format (rows,columns)
+    :filters: List of tuples (filter, size), see FILTER_BANK
+    return list with one 2D array (float32) by filter
+    """
+    band = np.asarray(band, dtype=np.float64)
+    # Both filters do not change if a constant is subtracted, center the
+    # values to keep the sums of squares precise
+    valid = band[~np.isnan(band)]
+    band = band - (valid.mean() if valid.size > 0 else 0)
+
+    integral = integral_image(band)
+    squares = None
+    outputs = []
+    for kind, size in filters:
+        n = size * size
+        mean = box_sum(integral, size) / n
+        if kind == 'highpass':
+            out = band - mean
+        elif kind == 'contrast':
+            if squares is None:
+                squares = (integral_image(np.square(band))[0], integral[1])
+            std = np.sqrt(np.maximum(box_sum(squares, size) / n - np.square(mean), 0))
+            out = np.divide(band - mean, std, out=np.zeros_like(std), where=std > 0)
+            out[np.isnan(std)] = np.nan
+        else:
+            raise ValueError(f'The filter {kind} is not valid.')
+        outputs.append(out.astype(np.float32))
+    return outputs
+
+def bank_window(task: tuple):
+    """
+    Filter bank of one window (worker function). The halo is the radius
+    of the biggest kernel.
+    :task: Tuple (image, band, window, filters)
+    return (band, window, list of filtered arrays)
+    """
+    image, band, window, filters = task
+    radius = max(size for _, size in filters) // 2
+    halo = read_halo(image, band, window, radius)
+    return band, window, [f[radius:radius + window[3]] for f in filter_bank(halo, filters)]
+
+def filter_window(task: tuple):
+    """
+    High pass filter of one window (worker function). The window is
+    filtered with its halo and only its interior is returned, so the
+    result is the same as filtering the whole image at once.
+    :task: Tuple (image, band, window, size)
+    return (band, window, filtered array)
+    """
+    image, band, window, size = task
+    radius = size // 2
+    halo = read_halo(image, band, window, radius)
+    filtered = high_pass_band(halo, size)
+    return band, window, filtered[radius:radius + window[3]]
+
+def focal(image: str, output_path: str, size: int = 5, workers: int = 1,
+window_pixels: int = rb.WINDOW_PIXELS):
     """
     Compute High Pass Filter
+
+    The image is processed by windows (aligned with its native blocks)
+    read with a halo of size // 2 rows, so the memory used depends on the
+    window size and the number of workers, not on the image size.
     :image: Image to perform focal filter
     :output_path: File output path
+    :size: Odd kernel size (5 by default)
+    :workers: Number of windows filtered at the same time
+    :window_pixels: Approximated number of pixels read at once
     """
-    # init dask as threads (shared memory is required)
-    dask.config.set(pool=ThreadPool(1))
+    src_ds = gdal.Open(str(image), gdal.GA_ReadOnly)
+    n_bands = src_ds.RasterCount
 
-    # PAN image
-    pan_arr, projection, geoTrans = read_raster(image)[0:3]
+    # Create empty raster
+    out_img = rb.create_output(output_path, src_ds, n_bands, options=CREATION_OPTIONS)
 
-    # PAN spatial component
-    pan_spatial = high_pass_filter(pan_arr)
+    print("..Filter raster by windows")
+    windows = rb.block_windows(src_ds, window_pixels)
+    tasks = [
+        (image, band, window, size)
+        for band in range(1, n_bands + 1) for window in windows
+    ]
+    for band, window, filtered in rb.map_windows(filter_window, tasks, workers, "thread"):
+        out_img.GetRasterBand(band).WriteArray(filtered, window[0], window[1])
 
-    # Perform pansharpening
-    n_bands = pan_arr.shape[0] # MUL's band number
-    rows = pan_arr.shape[1]
-    columns = pan_arr.shape[2]
- 
-    # Create empty raster
-    creation_options = ['COMPRESS=DEFLATE','PREDICTOR=3']
-    tmp_file = os.path.normpath(output_path)
-    driver = gdal.GetDriverByName("GTiff")
-    out_img = driver.Create(
-        str(tmp_file),
-        columns,
-        rows,
-        n_bands,
-        gdal.GDT_Float32,
-        options=creation_options
+    out_img.FlushCache()
+    del out_img, src_ds
+
+def focal_bank(image: str, output_path: str, filters: list = FILTER_BANK, workers: int = 1,
+window_pixels: int = rb.WINDOW_PIXELS):
+    """
+    Compute a bank of focal filters (several kernel sizes) reading the
+    image once. The output has one band by image band and filter, named
+    after the filter (e.g. highpass_5x5 or B1_highpass_5x5 with several
+    image bands).
+    :image: Image to perform focal filters
+    :output_path: File output path
+    :filters: List of tuples (filter, size), see FILTER_BANK
+    :workers: Number of windows filtered at the same time
+    :window_pixels: Approximated number of pixels read at once
+    """
+    for kind, size in filters:
+        if size < 1 or size % 2 == 0:
+            raise ValueError("The kernel size must be an odd number.")
+
+    src_ds = gdal.Open(str(image), gdal.GA_ReadOnly)
+    n_bands = src_ds.RasterCount
+
+    out_img = rb.create_output(
+        output_path, src_ds, n_bands * len(filters), options=CREATION_OPTIONS
     )
+    for band in range(1, n_bands + 1):
+        for i, (kind, size) in enumerate(filters):
+            name = f'{kind}_{size}x{size}'
+            if n_bands > 1:
+                name = f'B{band}_' + name
+            out_img.GetRasterBand((band - 1) * len(filters) + i + 1).SetDescription(name)
+
+    print(f"..Filter raster by windows with {len(filters)} filters")
+    windows = rb.block_windows(src_ds, window_pixels)
+    tasks = [
+        (image, band, window, filters)
+        for band in range(1, n_bands + 1) for window in windows
+    ]
+    for band, window, filtered in rb.map_windows(bank_window, tasks, workers, "thread"):
+        for i, arr in enumerate(filtered):
+            out_band = out_img.GetRasterBand((band - 1) * len(filters) + i + 1)
+            out_band.WriteArray(arr, window[0], window[1])
 
-    # Pan image has 3D size, get the first band (and the only one)
-    # pan_arr2d = pan_arr[0,:,:]
-    pan_spatial2d = pan_spatial[0,:,:]
-    pansharpen_band = out_img.GetRasterBand(1)
-    pansharpen_band.WriteArray(np.array(pan_spatial2d))
-
-    # set projection and geotransform
-    if geoTrans is not None:
-        out_img.SetGeoTransform(geoTrans)
-    if projection is not None:
-        out_img.SetProjection(projection)
-    out_img.FlushCache()
\ No newline at end of file
+    out_img.FlushCache()
+    del out_img, src_ds
\ No newline at end of file
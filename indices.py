@@ -3,12 +3,41 @@ Script Name:          indices.py
 Description:          Formulas to apply spectral indices with gdal calc
                       command to apply in GDAL version "3.1.4"
 ____________________________________________________________________________"""
-import os, re
+import os
+import ast
 import json
+import operator
 import subprocess
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from osgeo import gdal
+import rasterblocks as rb
 
 INDICES_MTDT_PATH = os.path.join(os.path.normpath(__file__), os.pardir, 'indices.json')
 
+# gdal_calc letters, linked to the index bands by band order
+GDAL_LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+# Formula operators allowed inside indices.json
+BINARY_OPERATORS = {
+    ast.Add: 'add',
+    ast.Sub: 'sub',
+    ast.Mult: 'mul',
+    ast.Div: 'truediv',
+    ast.Pow: 'pow'
+}
+UNARY_OPERATORS = {
+    ast.USub: 'neg',
+    ast.UAdd: 'pos'
+}
+# Operators whose operands can be swapped without changing the result
+COMMUTATIVE_OPERATORS = ['add', 'mul']
+
+# NIR indices are computed twice: with B7 (N) in the pansharpened image and
+# with B8 (N2) in the 120cm image
+NIR_BAND = "N"
+NIR_BAND_120CM = "N2"
+
 def check_bands(img_band_keys: list, index_bands: list) -> bool:
     """
     Test if the index bands are inside image bands.
@@ -18,30 +47,69 @@ def check_bands(img_band_keys: list, index_bands: list) -> bool:
             return False
     return True
 
-def compute_index(index_key, img_path, img_bands_pos, img_bands, out_dir, img_path_120cm = False):
+def plan_indices(indices_mtd: dict, img_path, img_bands_pos, img_bands, out_dir, img_path_120cm = False) -> list:
     """
-    Write and perform gdal_calc command in cmd to compute a spectral
-    index.
+    Plan the passes required to compute the indices at both resolutions.
 
-    :index_key: Index short name. Must be the same as JSON's key inside index
-    metadata is stored.
-    :img_path: MUL image path.
-    :img_path_120m: MUL image without pansharpening
+    Each pass is a dict with:
+
+    - tag: Resolution tag written in the output names (30cm | 120cm).
+    - img_path: Image to read.
+    - band_positions: Band key as key and its band number as value.
+    - indices: Index key as key and its metadata as value.
+    - out_paths: Index key as key and output image path as value.
+
+    The 120cm pass reads the MUL image without pansharpening and switches
+    the NIR band (N) by the second NIR band (N2). It only holds NIR indices.
+
+    :indices_mtd: Index key as key and its indices.json metadata as value.
+    All of them must be computable with img_bands.
+    :img_path: Pansharpened image path.
     :img_bands_pos: Position of image bands linked to img_bands keys.
     :img_bands: Image band keys.
-    :out_dir: Directory to store image.
+    :out_dir: Directory to store images.
+    :img_path_120cm: MUL image without pansharpening.
     """
+    img_name = os.path.basename(img_path).split('.')[0]
+    band_positions = dict(zip(img_bands, img_bands_pos))
 
-    # Open index metadata's JSON
-    indices_mtd = open(INDICES_MTDT_PATH)
-    indices_mtd_json = json.load(indices_mtd)
+    passes = [{
+        'tag': '30cm',
+        'img_path': img_path,
+        'band_positions': band_positions,
+        'indices': dict(indices_mtd)
+    }]
 
-    # Get index parameters
-    index_bands = indices_mtd_json[index_key]['bands']
-    formula = str(indices_mtd_json[index_key]['formula'])
+    if img_path_120cm:
+        band_positions_120 = dict(band_positions)
+        band_positions_120[NIR_BAND] = band_positions[NIR_BAND_120CM]
+        passes.append({
+            'tag': '120cm',
+            'img_path': img_path_120cm,
+            'band_positions': band_positions_120,
+            'indices': {k: v for k, v in indices_mtd.items() if NIR_BAND in v['bands']}
+        })
 
-    if not check_bands(img_bands, index_bands):
-        raise ValueError(f'Index required band is not inside the image.')
+    for p in passes:
+        p['out_paths'] = {}
+        for index_key in p['indices']:
+            p['out_paths'][index_key] = os.path.join(
+                out_dir, img_name + '_' + p['tag'] + '_' + index_key + '.tif'
+            )
+    return passes
+
+def gdal_calc_command(index_key, index_mtd: dict, img_path, band_positions: dict, out_path) -> str:
+    """
+    Write gdal_calc command to compute a spectral index.
+
+    :index_key: Index short name.
+    :index_mtd: Index metadata from indices.json.
+    :img_path: Image path.
+    :band_positions: Band key as key and its band number as value.
+    :out_path: Output image path.
+    """
+    index_bands = index_mtd['bands']
+    formula = str(index_mtd['formula'])
 
     # Get the src where gdal tool is located
     module = os.path.abspath(os.path.join(__file__, os.pardir))
@@ -49,26 +117,17 @@ def compute_index(index_key, img_path, img_bands_pos, img_bands, out_dir, img_pa
     gdal_calc = [f'python "{module}/gdal_calc.py" --quiet']
 
     # 1. Switch bands keys in index's formula with abecedary letters (by band order)
-    abc = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-    modified_formula = formula
+    gdal_letters = dict(zip(index_bands, GDAL_LETTERS))
+    modified_formula = rename_formula(formula, index_bands, gdal_letters)
     gdal_bands_src = []
     gdal_bands_n = []
-    for i in range(0, len(index_bands)):
-        b = index_bands[i]
-        gdal_band = abc[i]
-        modified_formula = modified_formula.replace(b, gdal_band)
-
+    for b, gdal_band in gdal_letters.items():
         # 2. Write connection between new gdal letter and image band number
-        img_band_n = img_bands_pos[img_bands.index(b)]
         band_src = f'-{gdal_band} "{img_path}"'
-        band_n = f'--{gdal_band}_band={img_band_n}'
+        band_n = f'--{gdal_band}_band={band_positions[b]}'
         gdal_bands_src.append(band_src)
         gdal_bands_n.append(band_n)
 
-    # Output image
-    img_name = os.path.basename(img_path).split('.')[0]
-    out_path = os.path.join(out_dir, img_name + '_30cm_' + index_key + '.tif')
-
     gdal_calc.append(f'--calc="{modified_formula}"')
     gdal_calc.append(" ".join(gdal_bands_n))
     gdal_calc.append(" ".join(gdal_bands_src))
@@ -86,49 +145,396 @@ def compute_index(index_key, img_path, img_bands_pos, img_bands, out_dir, img_pa
         f'..Calc bands: {" ".join(gdal_bands_n)}\n' +
         f'..GDAL command:\n\n{command}'
     )
+    return command
 
-    output = subprocess.check_output(command, shell=True)
+def compute_index(index_key, img_path, img_bands_pos, img_bands, out_dir, img_path_120cm = False):
+    """
+    Write and perform gdal_calc command in cmd to compute a spectral
+    index.
+
+    :index_key: Index short name. Must be the same as JSON's key inside index
+    metadata is stored.
+    :img_path: MUL image path.
+    :img_path_120m: MUL image without pansharpening
+    :img_bands_pos: Position of image bands linked to img_bands keys.
+    :img_bands: Image band keys.
+    :out_dir: Directory to store image.
+    """
+    index_mtd = load_indices([index_key])
+
+    if not check_bands(img_bands, index_mtd[index_key]['bands']):
+        raise ValueError(f'Index required band is not inside the image.')
 
     # Compute Nir IVs twice: with 7 and 8 bands respectively
-    if "N" in index_bands and img_path_120cm:
-        command_120 = re.sub("_band=7","_band=8", command)
-        command_120 = re.sub("_30cm","_120cm", command_120)
-        command_120 = re.sub(img_path,img_path_120cm, command_120)
-    
-        print("\nCompute IV again switching the NIR bands..")
-        output = subprocess.check_output(command_120, shell=True)
+    passes = plan_indices(index_mtd, img_path, img_bands_pos, img_bands, out_dir, img_path_120cm)
+    for p in passes:
+        if index_key not in p['indices']:
+            continue
+        if p['tag'] == '120cm':
+            print("\nCompute IV again switching the NIR bands..")
+        command = gdal_calc_command(
+            index_key,
+            p['indices'][index_key],
+            p['img_path'],
+            p['band_positions'],
+            p['out_paths'][index_key]
+        )
+        output = subprocess.check_output(command, shell=True)
+
+def load_indices(index_keys = True) -> dict:
+    """
+    Read index metadata from indices.json.
+
+    :index_keys: If there is no true, list of index keys to retrieve.
+    """
+    with open(INDICES_MTDT_PATH) as idx_metadata:
+        idx_metadata_json = json.load(idx_metadata)
+
+    if index_keys == True:
+        return idx_metadata_json
+    return {k: idx_metadata_json[k] for k in index_keys}
+
+def parse_formula(formula: str, index_bands: list):
+    """
+    Parse an index formula into a python expression tree whose names
+    are the index band keys.
+
+    The formula can use the band keys of the index or the gdal_calc
+    letters (A, B, ...) linked to them by band order. Names are matched
+    as whole tokens, so N is never mistaken inside N2 nor R inside RE1.
+
+    :formula: Index formula.
+    :index_bands: Band keys required by the index.
+    """
+    class BandResolver(ast.NodeTransformer):
+        def visit_Name(self, node):
+            if node.id in index_bands:
+                return node
+            elif node.id in GDAL_LETTERS[0:len(index_bands)]:
+                node.id = index_bands[GDAL_LETTERS.index(node.id)]
+                return node
+            elif isinstance(getattr(np, node.id, None), np.ufunc):
+                return node
+            elif isinstance(getattr(np, node.id, None), float):
+                # numpy constants as pi
+                return ast.copy_location(ast.Constant(getattr(np, node.id)), node)
+            raise ValueError(f'Unknown name {node.id} in formula {formula}.')
+
+    return BandResolver().visit(ast.parse(str(formula), mode='eval'))
+
+def rename_formula(formula: str, index_bands: list, names: dict) -> str:
+    """
+    Rewrite an index formula switching its band keys.
 
+    :formula: Index formula.
+    :index_bands: Band keys required by the index.
+    :names: Band key as key and its new name as value.
+    """
+    tree = parse_formula(formula, index_bands)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id in names:
+            node.id = names[node.id]
+    return ast.unparse(tree)
 
-def compute_all_indices(img_path, img_bands_pos, img_bands, out_dir, img_120cm_path = False, all = True):
+def compile_indices(indices_mtd: dict) -> dict:
+    """
+    Compile index formulas into one expression graph.
+
+    Each formula is parsed once and its subexpressions are merged with the
+    ones of the other indices, so a shared term like (N - R) is a single
+    graph node computed once per pixel. Operations between constants are
+    solved at compile time.
+
+    The graph is a dict with:
+
+    - nodes: List of operations ordered by dependencies. Each one is a
+    tuple (operation, arguments): ('band', key), ('const', value),
+    (operator name, node ids) or ('call', numpy function, node ids).
+    - outputs: Index key as key and its node id as value.
+    - last_use: Node id as key and id of the last node requiring it.
+
+    :indices_mtd: Index key as key and its indices.json metadata as value.
+    """
+    nodes = []
+    node_ids = {}
+
+    def add_node(node) -> int:
+        if node not in node_ids:
+            node_ids[node] = len(nodes)
+            nodes.append(node)
+        return node_ids[node]
+
+    def fold(name, values):
+        if name == 'call':
+            return None
+        if all(nodes[v][0] == 'const' for v in values):
+            return ('const', getattr(operator, name)(*[nodes[v][1] for v in values]))
+        return None
+
+    def build(expr) -> int:
+        if isinstance(expr, ast.Expression):
+            return build(expr.body)
+        elif isinstance(expr, ast.Name):
+            return add_node(('band', expr.id))
+        elif isinstance(expr, ast.Constant) and isinstance(expr.value, (int, float)):
+            return add_node(('const', expr.value))
+        elif isinstance(expr, ast.BinOp) and type(expr.op) in BINARY_OPERATORS:
+            name = BINARY_OPERATORS[type(expr.op)]
+            args = (build(expr.left), build(expr.right))
+            if name in COMMUTATIVE_OPERATORS:
+                args = tuple(sorted(args))
+        elif isinstance(expr, ast.UnaryOp) and type(expr.op) in UNARY_OPERATORS:
+            name = UNARY_OPERATORS[type(expr.op)]
+            args = (build(expr.operand),)
+        elif isinstance(expr, ast.Call) and isinstance(expr.func, ast.Name):
+            args = tuple(build(a) for a in expr.args)
+            return add_node(('call', expr.func.id, args))
+        else:
+            raise ValueError(f'Formula element not supported: {ast.unparse(expr)}')
+
+        folded = fold(name, args)
+        return add_node(folded if folded is not None else (name, args))
+
+    outputs = {}
+    for index_key, index_mtd in indices_mtd.items():
+        outputs[index_key] = build(parse_formula(index_mtd['formula'], index_mtd['bands']))
+
+    last_use = {}
+    for node_id, node in enumerate(nodes):
+        if node[0] not in ['band', 'const']:
+            for arg in node[-1]:
+                last_use[arg] = node_id
+
+    return {'nodes': nodes, 'outputs': outputs, 'last_use': last_use}
+
+def run_graph(graph: dict, arrays: dict):
+    """
+    Evaluate a compiled index graph over numpy arrays.
+
+    Yield (index_key, array) as soon as each index is computed. Intermediate
+    arrays are released after their last use.
+
+    :graph: Graph from compile_indices().
+    :arrays: Band key as key and numpy array as value.
+    """
+    output_nodes = {}
+    for index_key, node_id in graph['outputs'].items():
+        output_nodes.setdefault(node_id, []).append(index_key)
+
+    values = {}
+    for node_id, node in enumerate(graph['nodes']):
+        if node[0] == 'band':
+            value = arrays[node[1]]
+        elif node[0] == 'const':
+            value = node[1]
+        elif node[0] == 'call':
+            value = getattr(np, node[1])(*[values[a] for a in node[2]])
+        else:
+            value = getattr(operator, node[0])(*[values[a] for a in node[1]])
+        values[node_id] = value
+
+        for index_key in output_nodes.get(node_id, []):
+            yield index_key, value
+
+        # free mem
+        if node[0] not in ['band', 'const']:
+            # The same node can be used twice (e.g. N*N)
+            for arg in set(node[-1]):
+                if graph['last_use'][arg] == node_id:
+                    del values[arg]
+
+def compute_window(task: tuple):
+    """
+    Compute the index graph inside one image window.
+
+    :task: Tuple (img_path, band_positions, indices_bands, graph, window)
+    where indices_bands has the index key as key and its bands as value.
+    return (window, results) with the index key as key and the float32
+    array as value.
+    """
+    img_path, band_positions, indices_bands, graph, window = task
+    src_ds = rb.open_dataset(img_path)
+
+    arrays = {}
+    masks = {}
+    for index_bands in indices_bands.values():
+        for b in index_bands:
+            if b not in arrays:
+                arrays[b], masks[b] = rb.read_window(src_ds, band_positions[b], window)
+    shape = (window[3], window[2])
+
+    results = {}
+    # Nodata masks are shared between indices with the same bands
+    nodata_masks = {}
+    with np.errstate(all='ignore'):
+        for index_key, result in run_graph(graph, arrays):
+            result = np.broadcast_to(result, shape).astype(np.float32)
+
+            index_bands = frozenset(indices_bands[index_key])
+            if index_bands not in nodata_masks:
+                nodata_mask = None
+                for b in index_bands:
+                    if masks[b] is not None:
+                        nodata_mask = masks[b] if nodata_mask is None else nodata_mask | masks[b]
+                nodata_masks[index_bands] = nodata_mask
+            nodata_mask = nodata_masks[index_bands]
+            if nodata_mask is not None:
+                result = np.where(nodata_mask, np.float32(rb.FLOAT32_NODATA), result)
+
+            results[index_key] = result
+    return window, results
+
+def compute_indices_block(img_path, band_positions: dict, indices_mtd: dict, out_paths: dict,
+workers: int = 1, pool: str = "thread"):
+    """
+    Compute several spectral indices reading the image only once.
+
+    The image is split in windows. Each window of every required band
+    is read and decoded once, then the expression graph merging all the
+    index formulas is evaluated on it. As gdal_calc, the output pixel is
+    nodata when any of the index bands is nodata.
+
+    Windows are computed on a pool of workers and written by this thread
+    in their original order, each index in its own output image or in a
+    band of a stacked image.
+
+    :img_path: Image path.
+    :band_positions: Band key as key and its band number as value.
+    :indices_mtd: Index key as key and its indices.json metadata as value.
+    :out_paths: Index key as key and output image path as value. The value
+    can also be a tuple (dataset, band number) to write the index inside
+    an open stack.
+    :workers: Number of workers computing windows at the same time.
+    :pool: thread | process
+    """
+    src_ds = gdal.Open(str(img_path), gdal.GA_ReadOnly)
+
+    out_bands = {}
+    out_imgs = []
+    for index_key in indices_mtd:
+        if isinstance(out_paths[index_key], tuple):
+            stack, band_number = out_paths[index_key]
+            out_bands[index_key] = stack.GetRasterBand(band_number)
+            continue
+        out_img = rb.create_output(out_paths[index_key], src_ds)
+        out_band = out_img.GetRasterBand(1)
+        out_band.SetNoDataValue(rb.FLOAT32_NODATA)
+        out_bands[index_key] = out_band
+        out_imgs.append(out_img)
+
+    graph = compile_indices(indices_mtd)
+    print(
+        f'..Expression graph: {len(graph["nodes"])} nodes ' +
+        f'for {len(indices_mtd)} indices'
+    )
+
+    # Several windows per worker to balance their load
+    window_pixels = rb.WINDOW_PIXELS
+    if workers > 1:
+        n_pixels = src_ds.RasterXSize * src_ds.RasterYSize
+        window_pixels = min(window_pixels, n_pixels // (4 * workers))
+
+    indices_bands = {k: v['bands'] for k, v in indices_mtd.items()}
+    tasks = [
+        (str(img_path), band_positions, indices_bands, graph, window)
+        for window in rb.block_windows(src_ds, window_pixels)
+    ]
+
+    for window, results in rb.map_windows(compute_window, tasks, workers, pool):
+        for index_key, result in results.items():
+            out_bands[index_key].WriteArray(result, window[0], window[1])
+
+    for out_img in out_imgs:
+        out_img.FlushCache()
+    del out_bands, out_imgs, src_ds
+
+def stack_bands(index_pass: dict) -> dict:
+    """
+    Band names and metadata of the indices of a pass inside a stack.
+
+    The band name is the resolution tag plus the index key (e.g. 30cm_NDVI).
+
+    :index_pass: Pass from plan_indices().
+    """
+    bands = {}
+    for index_key, index_mtd in index_pass['indices'].items():
+        bands[index_pass['tag'] + '_' + index_key] = {
+            'neochannel': 'index',
+            'index': index_key,
+            'long_name': index_mtd.get('long_name', index_key),
+            'formula': index_mtd['formula'],
+            'bands': ','.join(index_mtd['bands'])
+        }
+    return bands
+
+def compute_all_indices(img_path, img_bands_pos, img_bands, out_dir, img_120cm_path = False, all = True, engine = "numpy",
+workers: int = 1, pool: str = "thread", stacks: dict = None):
     """
     Perform compute_index() for all indice.json keys (all indices).
 
     :all: If there is no true, all parameter requires a list of iv's index keys
     to compute.
+    :engine: numpy | gdal_calc. With numpy the indices are computed in this
+    process reading the image once. With gdal_calc each index runs its own
+    gdal_calc command.
+    :workers: Number of workers computing image windows at the same time
+    (numpy engine only).
+    :pool: thread | process. Kind of workers.
+    :stacks: Resolution tag (30cm | 120cm) as key and stack dataset as value
+    (numpy engine only). The indices are written inside the stack bands
+    named by stack_bands() instead of one image per index.
     """
+    idx_metadata_json = load_indices(all)
 
-    if all != True:
-        idx_metadata_json = all
-    else:
-        # Open index metadata's JSON
-        idx_metadata = open(INDICES_MTDT_PATH)
-        idx_metadata_json = json.load(idx_metadata)
+    if engine == "gdal_calc":
+        for index_key in idx_metadata_json:
 
-    for index_key in idx_metadata_json:
+            # Compute all index but if there is one that cannot be performed
+            # pass to the next one
+            try:
+                if img_120cm_path:
+                    compute_index(index_key, img_path, img_bands_pos, img_bands, out_dir, img_120cm_path)
+                else:
+                    compute_index(index_key, img_path, img_bands_pos, img_bands, out_dir)
+            except ValueError:
+                err_msg = (
+                    f"Index {index_key} cannot be computed due to" +
+                    " the image does not contain some requested bands."
+                )
+                print("\n\n" + err_msg)
+                pass
+        return
+    elif engine != "numpy":
+        raise ValueError("The 'engine' parameter is not valid.")
 
-        # Compute all index but if there is one that cannot be performed
-        # pass to the next one
-        try:
-            if img_120cm_path:
-                compute_index(index_key, img_path, img_bands_pos, img_bands, out_dir, img_120cm_path)
-            else:
-                compute_index(index_key, img_path, img_bands_pos, img_bands, out_dir)
-        except ValueError:
+    # Keep the indices which can be performed
+    valid_indices = {}
+    for index_key, index_mtd in idx_metadata_json.items():
+        if check_bands(img_bands, index_mtd['bands']):
+            valid_indices[index_key] = index_mtd
+        else:
             err_msg = (
                 f"Index {index_key} cannot be computed due to" +
                 " the image does not contain some requested bands."
             )
             print("\n\n" + err_msg)
-            pass
 
-    idx_metadata.close()
+    # Plan both resolutions together and run their passes at the same time.
+    # Each pass reads its own image once for all its indices.
+    passes = plan_indices(valid_indices, img_path, img_bands_pos, img_bands, out_dir, img_120cm_path)
+    passes = [p for p in passes if len(p['indices']) > 0]
+    if len(passes) == 0:
+        return
+    for p in passes:
+        print(f'\nCompute {p["tag"]} indices: {", ".join(p["indices"])}')
+        if stacks is not None:
+            for index_key in p['indices']:
+                stack = stacks[p['tag']]
+                band_number = rb.stack_band(stack, p['tag'] + '_' + index_key)
+                p['out_paths'][index_key] = (stack, band_number)
+
+    def run_pass(p):
+        compute_indices_block(p['img_path'], p['band_positions'], p['indices'], p['out_paths'], workers, pool)
+
+    with ThreadPool(len(passes)) as pass_pool:
+        pass_pool.map(run_pass, passes)
@@ -0,0 +1,112 @@
+"""____________________________________________________________________________
+Script Name:        manifest.py
+Description:        Incremental rebuild cache. Each processing stage stores a
+                    fingerprint of its inputs inside a JSON manifest, so the
+                    stages whose inputs did not change are skipped.
+____________________________________________________________________________"""
+import os
+import json
+import hashlib
+
+MANIFEST_NAME = 'manifest.json'
+
+def load_manifest(out_dir: str) -> dict:
+    """
+    Read the manifest stored inside an output folder. If it does not
+    exist, return an empty one.
+
+    :out_dir: Folder where the stage outputs are written.
+    """
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    manifest = {'files': {}, 'stages': {}}
+    if os.path.exists(path):
+        with open(path) as fp:
+            manifest.update(json.load(fp))
+    manifest['path'] = path
+    return manifest
+
+def save_manifest(manifest: dict):
+    """
+    Write the manifest. The file is replaced at once, so an interrupted
+    run never leaves a half written manifest.
+
+    :manifest: Manifest from load_manifest().
+    """
+    content = {k: v for k, v in manifest.items() if k != 'path'}
+    tmp_path = manifest['path'] + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(content, fp, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest['path'])
+
+def file_hash(path: str, manifest: dict = None) -> str:
+    """
+    Compute the SHA-256 hash of a file content.
+
+    When a manifest is given, the hash is stored with the file size and
+    modification time, and it is only computed again if any of them
+    changes.
+
+    :path: File path.
+    :manifest: Manifest from load_manifest().
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    file_id = [stat.st_size, stat.st_mtime_ns]
+
+    if manifest is not None:
+        known = manifest['files'].get(path)
+        if known is not None and known['id'] == file_id:
+            return known['hash']
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+
+    if manifest is not None:
+        manifest['files'][path] = {'id': file_id, 'hash': digest}
+    return digest
+
+def fingerprint(*inputs) -> str:
+    """
+    Combine the inputs of a stage (hashes, formulas, band mappings,
+    parameters...) into one fingerprint.
+
+    :inputs: Any JSON serializable values.
+    """
+    content = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def is_fresh(manifest: dict, stage: str, key: str, outputs: list) -> bool:
+    """
+    Test if a stage was already computed with the same fingerprint and
+    its outputs still exist.
+
+    :manifest: Manifest from load_manifest().
+    :stage: Stage name.
+    :key: Stage fingerprint.
+    :outputs: Paths written by the stage.
+    """
+    known = manifest['stages'].get(stage)
+    if known is None or known['fingerprint'] != key:
+        return False
+    for out in outputs:
+        if not os.path.exists(out):
+            return False
+    return True
+
+def record(manifest: dict, stage: str, key: str, outputs: list):
+    """
+    Store the fingerprint of a computed stage and save the manifest.
+
+    :manifest: Manifest from load_manifest().
+    :stage: Stage name.
+    :key: Stage fingerprint.
+    :outputs: Paths written by the stage.
+    """
+    manifest['stages'][stage] = {
+        'fingerprint': key,
+        'outputs': [os.path.abspath(out) for out in outputs]
+    }
+    save_manifest(manifest)
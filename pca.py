@@ -5,12 +5,19 @@ Prerequisites:      GDAL version "3.1.4" or greater
 ____________________________________________________________________________"""
 # 0. Import packages
 # =============================================================================
-import os, json, itertools
+import os, csv, json, itertools
 import numpy as np
-from osgeo import gdal
-from multiprocessing.pool import ThreadPool
-import dask
-from dask import array as da
+import rasterblocks as rb
+
+# Number of principal components written by image. Web mapping where pca
+# images are displayed not allow band selection
+N_PC = 3
+
+# Version of the PCA model files (see save_model)
+MODEL_VERSION = 1
+
+# Decimals of the ranking metric (see rank_combis)
+RANK_DECIMALS = 6
 
 # 1. Module functions
 # =============================================================================
@@ -93,110 +100,194 @@ def combis(band_keys: list, n_min: int, out_path: str) -> dict:
 
     return combis_dict
 
-def compute_pca(img_path: str, bands: list, out_path: str,
-estimator_matrix: str = "Covariance"):
+def block_moments(block) -> dict:
     """
-    Perform PCA with selected bands and export new image
-    with principal components as bands.
+    Compute the moments of a block of valid pixels.
 
-    :img_path: Image path.
-    :bands: List with selected bands to compute PCA.
-    :out_path: Output image path
-    :estimator_matrix: Correlation | Covariance
+    :block: Array with shape (n_bands, n_pixels).
+    return dict with count, mean and m2 (sum of the cross-products of the
+    deviations from the mean).
+    """
+    block = block.astype(np.float64)
+    count = block.shape[1]
+    if count == 0:
+        n_bands = block.shape[0]
+        return {'count': 0, 'mean': np.zeros(n_bands), 'm2': np.zeros((n_bands, n_bands))}
+    mean = block.mean(axis=1)
+    deviations = block - mean[:, None]
+    return {'count': count, 'mean': mean, 'm2': deviations @ deviations.T}
+
+def merge_moments(a: dict, b: dict) -> dict:
+    """
+    Merge the moments of two sets of pixels (Chan et al. pairwise update).
 
-    From PCA4CD QGIS plugin
-    https://github.com/SMByC/PCA4CD/blob/master/core/pca_dask_gdal.py
-    copyright: (C) 2018-2019 by Xavier Corredor Llano, SMByC
+    The deviations are always taken from each set mean, so the merge
+    does not lose precision when the band values are large.
 
-    Important:
-    - The number of PCs is 3 in this version. It could be until the max
-    number of bands.
-    - Dask block size is computed automatically.
-    - It's assumed image data is in float32
-    - All bands must have the same dimensions
+    :a: Moments of the first set (or None).
+    :b: Moments of the second set.
+    """
+    if a is None or a['count'] == 0:
+        return dict(b)
+    if b['count'] == 0:
+        return dict(a)
+
+    count = a['count'] + b['count']
+    delta = b['mean'] - a['mean']
+    merged = dict(a)
+    merged['count'] = count
+    merged['mean'] = a['mean'] + delta * (b['count'] / count)
+    merged['m2'] = a['m2'] + b['m2'] + np.outer(delta, delta) * (a['count'] * b['count'] / count)
+    return merged
+
+def band_moments(img_path: str, bands: list, window_pixels: int = rb.WINDOW_PIXELS,
+sample_fraction: float = 1, sample_mode: str = "stride", seed: int = 0) -> dict:
     """
-    # Init dask as threads (shared memory is required)
-    dask.config.set(pool=ThreadPool(1))
+    Compute the band means and the covariance matrix of several bands
+    in one streaming pass over the image.
+
+    The image is read window by window. The moments of each window are
+    merged with the ones of the previous windows, so the memory used
+    depends on the window size and not on the image size.
 
-    raw_image = []
-    nodata_mask = None
-    src_ds = gdal.Open(str(img_path), gdal.GA_ReadOnly)
+    Only the pixels valid in all the bands are used (common nodata mask).
+    The matrix of any band subset is a submatrix of this one, so all the
+    PCA combinations can share it (see compute_pca moments parameter).
 
-    nodata = None
-    # Image dimensions
-    img_rows = None
-    img_columns = None
+    With a sample fraction lower than 1, only a subset of the native block
+    rows is read (see rasterblocks.sample_windows). The eigenvectors are
+    usually stable with a few percent of the pixels; sampling_report()
+    measures the error for a given fraction.
 
+    :img_path: Image path.
+    :bands: List with the bands.
+    :window_pixels: Approximated number of pixels read at once.
+    :sample_fraction: Fraction of the image used to estimate the moments.
+    :sample_mode: stride | random
+    :seed: Random seed (random sample mode).
+    return dict with bands, count (valid pixels), mean and m2 (sum of the
+    cross-products of the deviations from the mean).
+    """
+    src_ds = rb.open_raster(img_path)
+
+    # Specify the nodata value, all bands must have the same
+    nodata = src_ds.GetRasterBand(bands[0]).GetNoDataValue()
     for band in bands:
-        src_ds_band = src_ds.GetRasterBand(band).ReadAsArray()
+        nodata_value = src_ds.GetRasterBand(band).GetNoDataValue()
+        if nodata is None or nodata_value is None:
+            same_nodata = nodata is None and nodata_value is None
+        else:
+            same_nodata = nodata == nodata_value or (np.isnan(nodata) and np.isnan(nodata_value))
+        if not same_nodata:
+            raise ValueError("Image nodata value must be equal in all bands.")
 
-        # Retrieve image dimensions
-        rows = src_ds_band.shape[0]
-        columns = src_ds_band.shape[1]
+    if sample_fraction < 1:
+        print(f"..Compute band means and covariance matrix ({sample_fraction:.1%} sample)\n")
+        windows = rb.sample_windows(src_ds, sample_fraction, sample_mode, seed)
+    else:
+        print("..Compute band means and covariance matrix\n")
+        windows = rb.block_windows(src_ds, window_pixels)
+
+    moments = None
+    for window in windows:
+        block = []
+        nodata_mask = None
+        for band in bands:
+            arr, mask = rb.read_window(src_ds, band, window)
+            if mask is not None:
+                nodata_mask = mask if nodata_mask is None else nodata_mask | mask
+            block.append(arr.ravel())
+        block = np.vstack(block)
+
+        # Pair-masking data, let only the valid data across all dimensions/bands
+        if nodata_mask is not None:
+            block = block[:, ~nodata_mask.ravel()]
+        moments = merge_moments(moments, block_moments(block))
+
+    moments['bands'] = list(bands)
+    # free mem
+    del src_ds
+    return moments
 
-        if img_rows is None:
-            img_rows = rows
-        elif img_rows != rows:
-            raise ValueError("All bands must have same dimensions.")
+def scene_moments(task: tuple) -> dict:
+    """
+    Perform band_moments() for one scene (worker function).
 
-        if img_columns is None:
-            img_columns = columns
-        elif img_columns != columns:
-            raise ValueError("All bands must have same dimensions.")
+    :task: Tuple (img_path, bands).
+    """
+    img_path, bands = task
+    print(f"..Scene {img_path}\n")
+    return band_moments(img_path, bands)
 
-        ds = src_ds_band.flatten().astype(np.float32)
+def scenes_moments(img_paths: list, bands: list, workers: int = 1) -> dict:
+    """
+    Compute the band means and the covariance matrix of several scenes
+    (mosaic tiles or dates of a time series) as if they were one image.
+
+    Each scene is streamed window by window (see band_moments) and its
+    moments are merged with the ones of the previous scenes, so the
+    scenes never need to be in memory together.
+
+    :img_paths: List with the scene paths. The bands must be in the same
+    position in all of them.
+    :bands: List with the bands.
+    :workers: Number of scenes read at the same time.
+    return dict with the same format as band_moments().
+    """
+    moments = None
+    tasks = [(img_path, bands) for img_path in img_paths]
+    for scene in rb.map_windows(scene_moments, tasks, workers, "thread"):
+        moments = merge_moments(moments, scene)
+    moments['bands'] = list(bands)
+    return moments
+
+def moments_matrix(moments: dict, bands: list, estimator_matrix: str = "Covariance") -> tuple:
+    """
+    Select the band means and the estimation matrix of a band subset
+    from the moments of all the bands.
 
-        # Specify the nodata value, all bands must have the same
-        nodata_value = src_ds.GetRasterBand(band).GetNoDataValue()
-        if nodata is None:
-            nodata = nodata_value
-        elif nodata != nodata_value:
-            raise ValueError("Image nodata value must be equal in all bands.")
+    Both estimators come from the same accumulated moments: the
+    correlation matrix is the covariance matrix normalized by the band
+    standard deviations. A constant band (zero variance) is uncorrelated
+    with the rest.
 
-        # Handle nodata mask
-        if np.isnan(nodata):
-            nodata_mask = np.isnan(ds) if nodata_mask is None else np.logical_or(nodata_mask, np.isnan(ds))
-        elif nodata is not None:
-            nodata_mask = ds == nodata if nodata_mask is None else np.logical_or(nodata_mask, ds == nodata)
-        raw_image.append(ds)
-
-    # Pair-masking data, let only the valid data across all dimensions/bands
-    if nodata is not None:
-        raw_image = [b[~nodata_mask] for b in raw_image]
-
-    # Stack the array with flattened bands into a numpy array
-    # with row dimension = number of image bands
-    flat_dims = da.vstack(raw_image).rechunk(('auto'))
-    n_bands = flat_dims.shape[0]
-
-    print("..Scaling the matrix\n")
-    # Compute the mean of each band.
-    band_mean = []
-    for i in range(n_bands):
-        band_mean.append(dask.delayed(np.mean)(flat_dims[i]))
-    band_mean = dask.compute(*band_mean)
-
-    print("..Compute covariance/correlation\n")
-    # Empty array to save new matrix with cov/corr between all bands
-    estimation_matrix = np.empty((n_bands, n_bands))
-    if estimator_matrix == "Correlation":
-        for i in range(n_bands):
-            deviation_scores_band_i = flat_dims[i] - band_mean[i]
-            for j in range(i, n_bands):
-                deviation_scores_band_j = flat_dims[j] - band_mean[j]
-                estimation_matrix[j][i] = estimation_matrix[i][j] = \
-                    da.corrcoef(deviation_scores_band_i, deviation_scores_band_j)[0][1]
-    elif estimator_matrix == "Covariance":
-        for i in range(n_bands):
-            deviation_scores_band_i = flat_dims[i] - band_mean[i]
-            for j in range(i, n_bands):
-                deviation_scores_band_j = flat_dims[j] - band_mean[j]
-                estimation_matrix[j][i] = estimation_matrix[i][j] = \
-                    da.cov(deviation_scores_band_i, deviation_scores_band_j)[0][1]
+    :moments: Dict returned by band_moments().
+    :bands: List with selected bands (must be inside moments bands).
+    :estimator_matrix: Correlation | Covariance
+    return (band_mean, estimation_matrix)
+    """
+    if moments['count'] < 2:
+        raise ValueError("Not enough valid pixels to compute the estimation matrix.")
+
+    idx = [moments['bands'].index(b) for b in bands]
+    band_mean = moments['mean'][idx]
+    # Sample covariance (ddof=1)
+    cov = moments['m2'][np.ix_(idx, idx)] / (moments['count'] - 1)
+
+    if estimator_matrix == "Covariance":
+        estimation_matrix = cov
+    elif estimator_matrix == "Correlation":
+        std = np.sqrt(np.diag(cov))
+        std_outer = np.outer(std, std)
+        estimation_matrix = np.divide(
+            cov, std_outer, out=np.zeros_like(cov), where=std_outer > 0
+        )
+        np.fill_diagonal(estimation_matrix, 1)
     else:
         raise ValueError("The 'estimator_matrix' parameter is not valid.")
-    # free mem
-    del raw_image, flat_dims, ds
+    return band_mean, estimation_matrix
+
+def fit_pca(moments: dict, bands: list, estimator_matrix: str = "Covariance") -> tuple:
+    """
+    Compute the eigenvalues and the first N_PC eigenvectors of a band
+    subset from its moments.
+
+    :moments: Dict returned by band_moments() with (at least) the bands.
+    :bands: List with selected bands.
+    :estimator_matrix: Correlation | Covariance
+    return (band_mean, eigenvals, eigenvectors)
+    """
+    band_mean, estimation_matrix = moments_matrix(moments, bands, estimator_matrix)
 
     if estimation_matrix[~np.isnan(estimation_matrix)].size == 0:
         raise ValueError("Invalid estimation matrix.")
@@ -216,68 +307,624 @@ estimator_matrix: str = "Covariance"):
 
     # select the first n eigenvectors (n is desired dimension
     # of rescaled data array, or dims_rescaled_data)
-    n_pc = 3 # Web mapping where pca images are displayed not allow band selection
+    n_pc = N_PC
     eigenvectors = eigenvectors[:, :n_pc]
 
+    return band_mean, eigenvals, eigenvectors
+
+def compute_pca(img_path: str, bands: list, out_path: str,
+estimator_matrix: str = "Covariance", moments: dict = None, overviews: bool = True,
+model_path: str = None, sample_fraction: float = 1):
+    """
+    Perform PCA with selected bands and export new image
+    with principal components as bands.
+
+    :img_path: Image path.
+    :bands: List with selected bands to compute PCA.
+    :out_path: Output image path. It can also be a tuple (dataset, band
+    numbers) to write the PCs inside bands of an open stack.
+    :estimator_matrix: Correlation | Covariance
+    :moments: Dict returned by band_moments() with (at least) the selected
+    bands. When it is given, the image is not read to compute the
+    estimation matrix and the band means.
+    :overviews: Build the output overviews. Set it to False to build them
+    later with rasterblocks.build_overviews() together with other outputs.
+    :model_path: Path to save the fitted model (see save_model) and apply
+    it later to other images without fitting it again.
+    :sample_fraction: Fraction of the image used to estimate the moments
+    when they are not given (see band_moments).
+
+    From PCA4CD QGIS plugin
+    https://github.com/SMByC/PCA4CD/blob/master/core/pca_dask_gdal.py
+    copyright: (C) 2018-2019 by Xavier Corredor Llano, SMByC
+
+    Important:
+    - The number of PCs is 3 in this version. It could be until the max
+    number of bands.
+    - The moments are accumulated window by window (see band_moments).
+    - It's assumed image data is in float32
+    - All bands must have the same dimensions
+    """
+    if moments is not None:
+        print("..Select the shared covariance/correlation matrix\n")
+    else:
+        moments = band_moments(img_path, bands, sample_fraction=sample_fraction)
+    band_mean, eigenvals, eigenvectors = fit_pca(moments, bands, estimator_matrix)
+    if model_path is not None:
+        save_model(
+            make_model(bands, band_mean, eigenvals, eigenvectors, estimator_matrix), model_path
+        )
+
     print("..Save new tif image\n")
-    # Create empty raster
-    creation_options = ['COMPRESS=DEFLATE','PREDICTOR=3']
-    tmp_file = os.path.normpath(out_path)
-    driver = gdal.GetDriverByName("GTiff")
-    out_img = driver.Create(
-        str(tmp_file),
-        img_columns,
-        img_rows,
-        n_bands,
-        gdal.GDT_Float32,
-        options=creation_options
-    )
+    write_components(img_path, bands, band_mean, eigenvectors, out_path)
 
-    def select_band(band_num):
-        """
-        Select the image band number from 'bands' variable.
-        The bands integrated in PCA could not be 1,2,3
-        """
-        return bands[band_num]
+    # compute the pyramids for the pc_image
+    if overviews and not isinstance(out_path, tuple):
+        rb.build_overviews([out_path])
 
-    def get_raw_band_from_stack(band_num):
-        selected_band = select_band(band_num)
-        return src_ds.GetRasterBand(selected_band).ReadAsArray().flatten().astype(np.float32)
+    return eigenvals, eigenvectors
 
-    for i in range(n_pc):
-        pc = 0
+def write_components(img_path: str, bands: list, band_mean, eigenvectors, out_path,
+window_pixels: int = rb.WINDOW_PIXELS):
+    """
+    Project the image bands over the eigenvectors and write the
+    principal components.
 
-        print(f"....Compute PC{i + 1}\n")
-        for j in range(n_bands):
-            pc = pc + eigenvectors[j, i] * (get_raw_band_from_stack(j) - band_mean[j])
+    Each window of the selected bands is read once, centered with the band
+    means and projected with one matrix multiplication, then all the PCs
+    of the window are written. A pixel is nodata in the PCs when it is
+    nodata in any selected band.
 
-        if nodata is not None:
-            pc[nodata_mask] = nodata
-        pc = pc.reshape((src_ds.RasterYSize, src_ds.RasterXSize))
+    :img_path: Image path.
+    :bands: List with selected bands.
+    :band_mean: Mean of each selected band.
+    :eigenvectors: Matrix with one column by PC.
+    :out_path: Output image path. It can also be a tuple (dataset, band
+    numbers) to write the PCs inside bands of an open stack.
+    :window_pixels: Approximated number of pixels read at once.
+    """
+    src_ds = rb.open_raster(img_path)
+    n_pc = eigenvectors.shape[1]
 
-        print("....Write PC as a band\n")
-        pc_band = out_img.GetRasterBand(i+1)
+    if isinstance(out_path, tuple):
+        # Write PCs inside an existing stack
+        out_img, pc_band_numbers = out_path
+    else:
+        # Create empty raster
+        out_img = rb.create_output(out_path, src_ds, n_pc)
+        pc_band_numbers = list(range(1, n_pc + 1))
+
+    # All bands must have the same nodata value (checked by band_moments)
+    nodata = src_ds.GetRasterBand(bands[0]).GetNoDataValue()
+    pc_bands = [out_img.GetRasterBand(n) for n in pc_band_numbers]
+    if isinstance(out_path, tuple):
+        # Stack bands keep their own nodata (a GeoTIFF has one by file)
+        pc_nodata = [pc_band.GetNoDataValue() for pc_band in pc_bands]
+    else:
+        pc_nodata = [nodata] * n_pc
         if nodata is not None:
-            pc_band.SetNoDataValue(nodata)
-        pc_band.WriteArray(pc)
-
-    # set projection and geotransform
-    geotrs = src_ds.GetGeoTransform()
-    if geotrs is not None:
-        out_img.SetGeoTransform(geotrs)
-    prj = src_ds.GetProjection()
-    if prj is not None:
-        out_img.SetProjection(prj)
+            for pc_band in pc_bands:
+                pc_band.SetNoDataValue(nodata)
+
+    projection = np.asarray(eigenvectors, dtype=np.float32).T
+    band_mean = np.asarray(band_mean, dtype=np.float32)[:, None]
+
+    for window in rb.block_windows(src_ds, window_pixels):
+        block = []
+        nodata_mask = None
+        for band in bands:
+            arr, mask = rb.read_window(src_ds, band, window)
+            if mask is not None:
+                nodata_mask = mask if nodata_mask is None else nodata_mask | mask
+            block.append(arr.ravel())
+
+        pcs = projection @ (np.vstack(block) - band_mean)
+        if nodata_mask is not None:
+            for i in range(n_pc):
+                if pc_nodata[i] is not None:
+                    pcs[i, nodata_mask.ravel()] = pc_nodata[i]
+        pcs = pcs.reshape((n_pc, window[3], window[2]))
+
+        for i in range(n_pc):
+            pc_bands[i].WriteArray(pcs[i], window[0], window[1])
+
     out_img.FlushCache()
-    del pc, pc_band, out_img
+    del pc_bands, out_img, src_ds
 
-    # free mem
-    del src_ds, nodata_mask
+def compute_combi(task: tuple) -> tuple:
+    """
+    Perform compute_pca() for one combination (worker function).
 
-    # compute the pyramids for the pc_image
-    os.system('gdaladdo -q --config BIGTIFF_OVERVIEW YES "{}"'.format(out_path))
+    :task: Tuple (img_path, bands, out_path, estimator_matrix, moments,
+    model_path, sample_fraction).
+    return (eigenvals, eigenvectors)
+    """
+    img_path, bands, out_path, estimator_matrix, moments, model_path, sample_fraction = task
+    return compute_pca(
+        img_path, bands, out_path, estimator_matrix, moments, overviews=False,
+        model_path=model_path, sample_fraction=sample_fraction
+    )
 
-    return eigenvals, eigenvectors
+def compute_pca_combis(img_path: str, combis_dict: dict, out_paths: dict,
+estimator_matrix: str = "Covariance", moments: dict = None,
+workers: int = 1, pool: str = "thread", cache_dir: str = None,
+overviews: bool = True, model_paths: dict = None, sample_fraction: float = 1) -> dict:
+    """
+    Perform compute_pca() for several combinations at the same time.
+
+    With more than one worker, the image is first decoded into a
+    memory-mapped scratch file (see rasterblocks.cache_raster) that all the
+    workers read, so the GeoTIFF is decompressed once and the decoded bands
+    are not copied by each worker. The scratch file is removed at the end.
+
+    :img_path: Image path.
+    :combis_dict: Combination id as key and list of bands as value.
+    :out_paths: Combination id as key and output image path as value.
+    Outputs inside a stack (tuple values) are always written by one worker.
+    :estimator_matrix: Correlation | Covariance
+    :moments: Dict returned by band_moments() shared by all combinations
+    (or None to compute the moments of each combination).
+    :workers: Number of combinations computed at the same time.
+    :pool: thread | process. Threads already share the scratch file pages;
+    a process pool re-imports the calling script in each worker, so that
+    script must run its code under `if __name__ == "__main__":`.
+    :cache_dir: Dir to write the scratch file (output dir of the first
+    combination by default).
+    :overviews: Build the overviews of all the outputs at the end (see
+    rasterblocks.build_overviews).
+    :model_paths: Combination id as key and path to save its fitted model
+    as value (see save_model).
+    :sample_fraction: Fraction of the image used to estimate the moments
+    of each combination when they are not shared (see band_moments).
+    return dict with combination id as key and (eigenvals, eigenvectors)
+    as value.
+    """
+    if model_paths is None:
+        model_paths = {}
+    if any(isinstance(out_path, tuple) for out_path in out_paths.values()):
+        workers = 1
+
+    cache_path = None
+    source = img_path
+    if workers > 1:
+        if cache_dir is None:
+            cache_dir = os.path.dirname(os.path.abspath(out_paths[next(iter(combis_dict))]))
+        name = os.path.basename(img_path).split('.')[0]
+        cache_path = os.path.join(cache_dir, name + '_bands' + rb.CACHE_EXTENSION)
+        print(f"..Decode image bands into {cache_path}\n")
+        source = rb.cache_raster(img_path, cache_path)
+
+    tasks = [
+        (source, combi_bands, out_paths[combi_id], estimator_matrix, moments,
+         model_paths.get(combi_id), sample_fraction)
+        for combi_id, combi_bands in combis_dict.items()
+    ]
+    try:
+        results = dict(zip(combis_dict, rb.map_windows(compute_combi, tasks, workers, pool)))
+    finally:
+        if cache_path is not None:
+            os.remove(cache_path)
+            os.remove(cache_path + '.json')
+
+    if overviews:
+        paths = [p for p in out_paths.values() if not isinstance(p, tuple)]
+        rb.build_overviews(paths, workers)
+    return results
+
+def rank_combis(moments: dict, combis_dict: dict, band_keys: list, out_path: str,
+estimator_matrix: str = "Covariance", top_k: int = None, min_explained: float = None) -> dict:
+    """
+    Rank the band combinations with metrics computed from the estimation
+    matrix alone (no image pass) and select the best ones.
+
+    - explained_variance: Percentage of the variance explained by the first
+    N_PC components.
+    - eigenvalue_spread: Ratio between the first and the N_PC eigenvalues.
+    Lower values mean the written PCs carry a more balanced information.
+
+    The explained variance grows with the number of bands and a combination
+    with N_PC bands or less always explains 100%, so the combinations are
+    ranked inside each number of bands: by explained variance, rounded to
+    RANK_DECIMALS so the ties (e.g. all the saturated combinations) are
+    solved with the lower spread and not by float round-off. The ranking
+    is written inside pca_band_ranking.csv, next to the pca_band_combis.csv
+    file created by combis().
+
+    :moments: Dict returned by band_moments() with all the image bands.
+    :combis_dict: Dict returned by combis().
+    :band_keys: Image band keys used to create the combinations.
+    :out_path: Dir where pca_band_ranking.csv is saved.
+    :estimator_matrix: Correlation | Covariance
+    :top_k: Keep only the best top_k combinations of each number of bands.
+    :min_explained: Keep only combinations whose explained variance (%) is
+    equal or greater than this value.
+    return dict with the selected combinations (same format as combis()).
+    """
+    metrics = {}
+    for combi_id, combi_bands in combis_dict.items():
+        estimation_matrix = moments_matrix(moments, combi_bands, estimator_matrix)[1]
+        eigenvals = np.sort(np.linalg.eigvalsh(estimation_matrix))[::-1]
+        explained = round(100 * eigenvals[:N_PC].sum() / eigenvals.sum(), RANK_DECIMALS)
+        last = eigenvals[min(N_PC, len(eigenvals)) - 1]
+        spread = eigenvals[0] / last if last > 0 else np.inf
+        metrics[combi_id] = (explained, spread)
+
+    ranking = sorted(
+        combis_dict,
+        key=lambda c: (len(combis_dict[c]), -metrics[c][0], metrics[c][1])
+    )
+
+    selected = {}
+    csv_header = '"id","bands","n_bands","explained_variance","eigenvalue_spread","rank","selected"'
+    csv_output = open(out_path + '/pca_band_ranking.csv', 'w')
+    csv_output.write(csv_header)
+    rank = 0
+    n_bands = None
+    for combi_id in ranking:
+        # Rank inside the combinations with the same number of bands
+        if len(combis_dict[combi_id]) != n_bands:
+            n_bands = len(combis_dict[combi_id])
+            rank = 0
+        rank += 1
+        explained, spread = metrics[combi_id]
+        is_selected = (top_k is None or rank <= top_k) and \
+            (min_explained is None or explained >= min_explained)
+        if is_selected:
+            selected[combi_id] = combis_dict[combi_id]
+
+        combi_selected_bands = '-'.join([band_keys[b - 1] for b in combis_dict[combi_id]])
+        csv_output.write(
+            f'\n{combi_id},"{combi_selected_bands}",{n_bands},{explained},{spread},'
+            f'{rank},{int(is_selected)}'
+        )
+    csv_output.close()
+
+    print(f"..Selected {len(selected)} of {len(combis_dict)} combinations\n")
+    # Keep the combination order
+    return {c: combis_dict[c] for c in combis_dict if c in selected}
+
+def read_ranking(combis_dict: dict, out_path: str) -> dict:
+    """
+    Read the combinations selected by a previous rank_combis() from
+    pca_band_ranking.csv, so the band moments are not computed again.
+
+    :combis_dict: Dict returned by combis().
+    :out_path: Dir where pca_band_ranking.csv is saved.
+    return dict with the selected combinations (same format as combis())
+    or None if the file does not store a ranking (rank the combinations
+    again).
+    """
+    with open(out_path + '/pca_band_ranking.csv', newline='') as csv_input:
+        reader = csv.DictReader(csv_input)
+        if reader.fieldnames is None or 'selected' not in reader.fieldnames:
+            return None
+        selected = {int(row['id']) for row in reader if row['selected'] == '1'}
+
+    print(f"..Selected {len(selected)} of {len(combis_dict)} combinations (previous ranking)\n")
+    return {c: combis_dict[c] for c in combis_dict if c in selected}
+
+def compute_pca_batch(img_path: str, combis_dict: dict, out_paths: dict,
+estimator_matrix: str = "Covariance", moments: dict = None,
+memory_limit: int = 256 * 1024 * 1024, overviews: bool = True,
+model_paths: dict = None, sample_fraction: float = 1) -> dict:
+    """
+    Perform the PCA of several band combinations reading the image once.
+
+    The eigenvectors of all the combinations are stacked in one projection
+    matrix with a row by PC and a column by image band (zero for the bands
+    outside the combination). Each image window is read once and projected
+    with that matrix, then the PCs of every combination are written in
+    their own output.
+
+    :img_path: Image path.
+    :combis_dict: Combination id as key and list of bands as value (see
+    combis()).
+    :out_paths: Combination id as key and output image path as value. The
+    value can also be a tuple (dataset, band numbers) to write inside a
+    stack.
+    :estimator_matrix: Correlation | Covariance
+    :moments: Dict returned by band_moments() with all the combination
+    bands. If it is None, it is computed first.
+    :memory_limit: Approximated bytes used by the PCs projected at once.
+    :overviews: Build the overviews of all the outputs at the end (see
+    rasterblocks.build_overviews).
+    :model_paths: Combination id as key and path to save its fitted model
+    as value (see save_model).
+    :sample_fraction: Fraction of the image used to estimate the moments
+    when they are not given (see band_moments).
+    return dict with combination id as key and (eigenvals, eigenvectors)
+    as value.
+    """
+    if model_paths is None:
+        model_paths = {}
+    # All the bands used by any combination
+    all_bands = sorted(set(b for combi_bands in combis_dict.values() for b in combi_bands))
+    if moments is None:
+        moments = band_moments(img_path, all_bands, sample_fraction=sample_fraction)
+    all_mean = moments_matrix(moments, all_bands)[0]
+
+    combi_ids = list(combis_dict)
+    n_combis = len(combi_ids)
+    n_all = len(all_bands)
+
+    print(f"..Fit {n_combis} combinations\n")
+    results = {}
+    # Projection matrix (n_combis * N_PC, n_all) and membership matrix
+    projection = np.zeros((n_combis * N_PC, n_all), dtype=np.float32)
+    membership = np.zeros((n_combis, n_all), dtype=np.float32)
+    offsets = np.zeros(n_combis * N_PC, dtype=np.float32)
+    for k, combi_id in enumerate(combi_ids):
+        combi_bands = combis_dict[combi_id]
+        band_mean, eigenvals, eigenvectors = fit_pca(moments, combi_bands, estimator_matrix)
+        results[combi_id] = (eigenvals, eigenvectors)
+        if combi_id in model_paths:
+            save_model(
+                make_model(combi_bands, band_mean, eigenvals, eigenvectors, estimator_matrix),
+                model_paths[combi_id]
+            )
+
+        idx = [all_bands.index(b) for b in combi_bands]
+        rows = slice(k * N_PC, (k + 1) * N_PC)
+        projection[rows, idx] = eigenvectors.T
+        membership[k, idx] = 1
+        # The image is centered with the mean of all bands, correct the
+        # combinations whose band means differ
+        offsets[rows] = eigenvectors.T @ (band_mean - all_mean[idx])
+
+    src_ds = rb.open_raster(img_path)
+    nodata = src_ds.GetRasterBand(all_bands[0]).GetNoDataValue()
+
+    # Output bands of every combination and their nodata values (the stack
+    # bands keep their own one, a GeoTIFF has one by file)
+    out_imgs = []
+    pc_bands = []
+    pc_nodata = []
+    for combi_id in combi_ids:
+        out_path = out_paths[combi_id]
+        if isinstance(out_path, tuple):
+            out_img, pc_band_numbers = out_path
+        else:
+            out_img = rb.create_output(out_path, src_ds, N_PC)
+            pc_band_numbers = list(range(1, N_PC + 1))
+            out_imgs.append(out_img)
+        for n in pc_band_numbers:
+            pc_band = out_img.GetRasterBand(n)
+            if isinstance(out_path, tuple):
+                pc_nodata.append(pc_band.GetNoDataValue())
+            else:
+                if nodata is not None:
+                    pc_band.SetNoDataValue(nodata)
+                pc_nodata.append(nodata)
+            pc_bands.append(pc_band)
+    has_nodata = np.array([v is not None for v in pc_nodata])
+    pc_nodata = np.array([np.nan if v is None else v for v in pc_nodata], dtype=np.float32)
+
+    print("..Project all combinations\n")
+    all_mean = all_mean.astype(np.float32)[:, None]
+    for window in rb.block_windows(src_ds):
+        n_pixels = window[2] * window[3]
+        # Combinations projected at once, limited by memory
+        group = max(1, memory_limit // (4 * N_PC * n_pixels))
+
+        block = []
+        invalid = []
+        for band in all_bands:
+            arr, mask = rb.read_window(src_ds, band, window)
+            block.append(arr.ravel())
+            invalid.append(np.zeros(n_pixels, dtype=bool) if mask is None else mask.ravel())
+        invalid = np.vstack(invalid)
+        deviations = np.vstack(block) - all_mean
+        # Nodata pixels must not spread to the combinations without that band
+        deviations[invalid] = 0
+        del block
+
+        for k0 in range(0, n_combis, group):
+            k1 = min(n_combis, k0 + group)
+            rows = slice(k0 * N_PC, k1 * N_PC)
+            pcs = projection[rows] @ deviations - offsets[rows, None]
+            if nodata is not None:
+                combi_invalid = (membership[k0:k1] @ invalid.astype(np.float32)) > 0
+                pc_invalid = np.repeat(combi_invalid, N_PC, axis=0) & has_nodata[rows, None]
+                pcs = np.where(pc_invalid, pc_nodata[rows, None], pcs)
+            pcs = pcs.reshape((-1, window[3], window[2]))
+            for r in range(pcs.shape[0]):
+                pc_bands[k0 * N_PC + r].WriteArray(pcs[r], window[0], window[1])
+
+    for out_img in out_imgs:
+        out_img.FlushCache()
+    del pc_bands, out_imgs, src_ds
+
+    # compute the pyramids for the pc_images
+    if overviews:
+        paths = [out_paths[c] for c in combi_ids if not isinstance(out_paths[c], tuple)]
+        rb.build_overviews(paths)
+
+    return results
+
+def stack_bands(combis_dict: dict, band_keys: list, prefix: str) -> dict:
+    """
+    Band names and metadata of the PCs of every combination inside a stack.
+
+    The band name is the prefix, the combination id and the PC number
+    (e.g. PCA31cm_C12_PC1).
+
+    :combis_dict: Dict returned by combis().
+    :band_keys: Image band keys used to create the combinations.
+    :prefix: First part of the band names.
+    """
+    bands = {}
+    for combi_id, combi_bands in combis_dict.items():
+        for i in range(N_PC):
+            bands[f'{prefix}_C{combi_id}_PC{i + 1}'] = {
+                'neochannel': 'pca',
+                'combi_id': combi_id,
+                'bands': '-'.join([band_keys[b - 1] for b in combi_bands]),
+                'pc': i + 1
+            }
+    return bands
+
+def make_model(bands: list, band_mean, eigenvals, eigenvectors,
+estimator_matrix: str = "Covariance") -> dict:
+    """
+    Gather everything needed to project an image with a fitted PCA.
+
+    :bands: List with the bands used to fit the PCA.
+    :band_mean: Mean of each band.
+    :eigenvals: All the eigenvalues (decreasing order).
+    :eigenvectors: Matrix with one column by PC.
+    :estimator_matrix: Correlation | Covariance
+    """
+    return {
+        'version': MODEL_VERSION,
+        'estimator_matrix': estimator_matrix,
+        'bands': [int(b) for b in bands],
+        'band_mean': np.asarray(band_mean, dtype=np.float64),
+        'eigenvals': np.asarray(eigenvals, dtype=np.float64),
+        'eigenvectors': np.asarray(eigenvectors, dtype=np.float64)
+    }
+
+def save_model(model: dict, out_path: str):
+    """
+    Write a PCA model (see make_model) as a JSON file.
+
+    :model: Dict returned by make_model().
+    :out_path: Output file path.
+    """
+    content = {
+        k: v.tolist() if isinstance(v, np.ndarray) else v
+        for k, v in model.items()
+    }
+    with open(os.path.abspath(out_path), 'w') as fp:
+        json.dump(content, fp, indent=2)
+
+def load_model(path: str) -> dict:
+    """
+    Read a PCA model written by save_model().
+
+    :path: Model file path.
+    """
+    with open(os.path.abspath(path)) as fp:
+        model = json.load(fp)
+    if model.get('version') != MODEL_VERSION:
+        raise ValueError(f'PCA model version of {path} is not supported.')
+    for k in ['band_mean', 'eigenvals', 'eigenvectors']:
+        model[k] = np.asarray(model[k], dtype=np.float64)
+    return model
+
+def apply_model(model, img_path: str, out_path, bands: list = None,
+overviews: bool = True):
+    """
+    Project an image (other scene, tile or AOI clip) with an already
+    fitted PCA model in one pass, without computing its moments.
+
+    :model: Dict returned by make_model()/load_model() or model file path.
+    :img_path: Image path.
+    :out_path: Output image path. It can also be a tuple (dataset, band
+    numbers) to write the PCs inside bands of an open stack.
+    :bands: Bands of the image matching the model bands (same order). By
+    default the model bands are used.
+    :overviews: Build the output overviews.
+    """
+    if isinstance(model, str):
+        model = load_model(model)
+    if bands is None:
+        bands = model['bands']
+    if len(bands) != len(model['bands']):
+        raise ValueError("The number of bands does not match the PCA model.")
+
+    print(f"..Apply PCA model ({model['estimator_matrix']}) to {img_path}\n")
+    write_components(img_path, bands, model['band_mean'], model['eigenvectors'], out_path)
+
+    if overviews and not isinstance(out_path, tuple):
+        rb.build_overviews([out_path])
+
+def compute_pca_scenes(img_paths: list, bands: list, out_paths: list,
+estimator_matrix: str = "Covariance", model_path: str = None, workers: int = 1) -> dict:
+    """
+    Fit one PCA over several scenes and project every scene with the
+    shared components, so the PCs are comparable between them (e.g.
+    change detection or mosaics without seams between tiles).
+
+    :img_paths: List with the scene paths.
+    :bands: List with selected bands (same position in all the scenes).
+    :out_paths: List with the output image path of each scene.
+    :estimator_matrix: Correlation | Covariance
+    :model_path: Path to save the shared model (see save_model).
+    :workers: Number of scenes read at the same time.
+    return the model (see make_model).
+    """
+    if len(img_paths) != len(out_paths):
+        raise ValueError("There must be one output path by scene.")
+
+    print(f"..Fit PCA over {len(img_paths)} scenes\n")
+    moments = scenes_moments(img_paths, bands, workers)
+    band_mean, eigenvals, eigenvectors = fit_pca(moments, bands, estimator_matrix)
+    model = make_model(bands, band_mean, eigenvals, eigenvectors, estimator_matrix)
+    if model_path is not None:
+        save_model(model, model_path)
+
+    for img_path, out_path in zip(img_paths, out_paths):
+        apply_model(model, img_path, out_path, overviews=False)
+    rb.build_overviews(out_paths, workers)
+    return model
+
+def eigenvector_angles(reference, eigenvectors) -> np.ndarray:
+    """
+    Angle (degrees) between each eigenvector and the reference one. The
+    sign of an eigenvector is arbitrary, so it is ignored.
+
+    :reference: Matrix with one column by PC.
+    :eigenvectors: Matrix with one column by PC (same shape).
+    """
+    cosines = np.abs(np.sum(reference * eigenvectors, axis=0))
+    cosines /= np.linalg.norm(reference, axis=0) * np.linalg.norm(eigenvectors, axis=0)
+    return np.degrees(np.arccos(np.clip(cosines, 0, 1)))
+
+def sampling_report(img_path: str, bands: list, fractions: list = (0.01, 0.05, 0.1, 0.25),
+estimator_matrix: str = "Covariance", sample_mode: str = "stride", out_path: str = None) -> dict:
+    """
+    Compare the PCA fitted with sampled moments against the exact fit, to
+    choose a safe sample fraction. Use a small benchmark image (e.g. an
+    AOI clip), since the exact moments are computed too.
+
+    CSV columns: fraction, pixels (valid pixels sampled), the angle
+    (degrees) between the sampled and the exact eigenvector of each PC
+    and the relative error of the explained variance (%).
+
+    :img_path: Image path.
+    :bands: List with selected bands.
+    :fractions: Sample fractions to test.
+    :estimator_matrix: Correlation | Covariance
+    :sample_mode: stride | random
+    :out_path: CSV file path to save the report (optional).
+    return dict with fraction as key and dict with pixels, angles and
+    explained_error as value.
+    """
+    exact = band_moments(img_path, bands)
+    exact_eigenvals, exact_eigenvectors = fit_pca(exact, bands, estimator_matrix)[1:]
+    exact_explained = exact_eigenvals[:N_PC].sum() / exact_eigenvals.sum()
+
+    report = {}
+    for fraction in fractions:
+        moments = band_moments(img_path, bands, sample_fraction=fraction, sample_mode=sample_mode)
+        eigenvals, eigenvectors = fit_pca(moments, bands, estimator_matrix)[1:]
+        explained = eigenvals[:N_PC].sum() / eigenvals.sum()
+        report[fraction] = {
+            'pixels': int(moments['count']),
+            'angles': eigenvector_angles(exact_eigenvectors, eigenvectors),
+            'explained_error': 100 * abs(explained - exact_explained) / exact_explained
+        }
+
+    if out_path is not None:
+        n_pc = exact_eigenvectors.shape[1]
+        header = ['"fraction"', '"pixels"'] + [f'"angle_pc{i + 1}"' for i in range(n_pc)]
+        csv_output = open(out_path, 'w')
+        csv_output.write(','.join(header + ['"explained_error"']))
+        for fraction, r in report.items():
+            row = [str(fraction), str(r['pixels'])] + [str(a) for a in r['angles']]
+            csv_output.write('\n' + ','.join(row + [str(r['explained_error'])]))
+        csv_output.close()
+    return report
 
 def write_stats(eigenvals, eigenvectors, outfile, outformat: str = "json"):
     """
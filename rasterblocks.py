@@ -0,0 +1,487 @@
+"""____________________________________________________________________________
+Script Name:        rasterblocks.py
+Description:        Helpers to read and write GDAL rasters window by window,
+                    so the neochannel stages never hold a full scene in memory.
+Prerequisites:      GDAL version "3.1.4" or greater
+____________________________________________________________________________"""
+import os
+import json
+import threading
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from dask import array as da
+from osgeo import gdal
+
+# Number of pixels read per window when the raster is not tiled
+WINDOW_PIXELS = 4 * 1024 * 1024
+
+# Float32 nodata value written by gdal_calc when --NoDataValue is not set
+FLOAT32_NODATA = float(np.finfo(np.float32).max)
+
+# Creation options of multiband (stacked) outputs by GDAL driver
+STACK_OPTIONS = {
+    'GTiff': [
+        'TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'INTERLEAVE=BAND',
+        'COMPRESS=DEFLATE', 'PREDICTOR=3', 'BIGTIFF=IF_SAFER'
+    ],
+    'Zarr': ['BLOCKSIZE=256,256', 'COMPRESS=ZLIB']
+}
+
+# GDAL configuration used while the overviews (pyramids) are built
+OVERVIEW_CONFIG = {
+    'BIGTIFF_OVERVIEW': 'YES',
+    'COMPRESS_OVERVIEW': 'DEFLATE',
+    'PREDICTOR_OVERVIEW': '3',
+    'GDAL_NUM_THREADS': 'ALL_CPUS'
+}
+
+# Overviews are added until the smallest one is below this size (pixels)
+OVERVIEW_MIN_SIZE = 256
+
+# GDAL datasets cannot be shared between threads, each one opens its own
+_local = threading.local()
+
+# Extension of the decoded band caches (see cache_raster)
+CACHE_EXTENSION = '.npy'
+
+class CachedBand():
+    """
+    Band of a CachedRaster with the GDAL band methods used to read it.
+    """
+    def __init__(self, raster, band: int):
+        self.raster = raster
+        self.band = band
+
+    def ReadAsArray(self, xoff: int = 0, yoff: int = 0, xsize: int = None, ysize: int = None):
+        xsize = self.raster.RasterXSize - xoff if xsize is None else xsize
+        ysize = self.raster.RasterYSize - yoff if ysize is None else ysize
+        return np.array(self.raster.array[self.band - 1, yoff:yoff + ysize, xoff:xoff + xsize])
+
+    def GetNoDataValue(self):
+        return self.raster.metadata['nodata'][self.band - 1]
+
+    def GetBlockSize(self):
+        return [self.raster.RasterXSize, 1]
+
+class CachedRaster():
+    """
+    Read only view of a decoded band cache (see cache_raster) with the
+    GDAL dataset methods used by the neochannel stages.
+
+    The bands are memory-mapped, so every process reading the cache shares
+    the same decoded copy through the system page cache.
+    """
+    def __init__(self, path: str):
+        self.array = np.load(path, mmap_mode='r')
+        with open(path + '.json') as fp:
+            self.metadata = json.load(fp)
+        self.RasterCount, self.RasterYSize, self.RasterXSize = self.array.shape
+
+    def GetRasterBand(self, band: int):
+        return CachedBand(self, band)
+
+    def GetGeoTransform(self):
+        return self.metadata['geotransform']
+
+    def GetProjection(self):
+        return self.metadata['projection']
+
+class RasterArray():
+    """
+    Array-like view of one raster band, read window by window on demand
+    (float32, with nodata pixels as NaN). It is the source of the lazy
+    arrays created by lazy_raster().
+    """
+    def __init__(self, path: str, band: int):
+        self.path = str(path)
+        self.band = band
+        ds = open_raster(self.path)
+        self.shape = (ds.RasterYSize, ds.RasterXSize)
+        self.dtype = np.dtype(np.float32)
+        self.ndim = 2
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (2 - len(key))
+        rows = range(*key[0].indices(self.shape[0]))
+        cols = range(*key[1].indices(self.shape[1]))
+        if len(rows) == 0 or len(cols) == 0:
+            return np.empty((len(rows), len(cols)), dtype=self.dtype)
+
+        y0, y1 = min(rows[0], rows[-1]), max(rows[0], rows[-1]) + 1
+        x0, x1 = min(cols[0], cols[-1]), max(cols[0], cols[-1]) + 1
+        arr, mask = read_window(open_dataset(self.path), self.band, (x0, y0, x1 - x0, y1 - y0))
+        if mask is not None:
+            arr[mask] = np.nan
+        return arr[rows[0] - y0::rows.step, cols[0] - x0::cols.step]
+
+def open_raster(path: str):
+    """
+    Open a raster in read mode. Band caches created with cache_raster()
+    are opened as CachedRaster.
+
+    :path: Raster path.
+    """
+    if str(path).endswith(CACHE_EXTENSION):
+        return CachedRaster(str(path))
+    return gdal.Open(str(path), gdal.GA_ReadOnly)
+
+def cache_raster(img_path: str, cache_path: str) -> str:
+    """
+    Decode all the bands of a raster once into an uncompressed float32
+    scratch file that can be memory-mapped by many workers.
+
+    :img_path: Raster path.
+    :cache_path: Scratch file path (it must end with .npy).
+    return cache_path
+    """
+    if not cache_path.endswith(CACHE_EXTENSION):
+        raise ValueError(f'The cache path must end with {CACHE_EXTENSION}.')
+
+    src_ds = gdal.Open(str(img_path), gdal.GA_ReadOnly)
+    n_bands = src_ds.RasterCount
+    cache = np.lib.format.open_memmap(
+        cache_path,
+        mode='w+',
+        dtype=np.float32,
+        shape=(n_bands, src_ds.RasterYSize, src_ds.RasterXSize)
+    )
+    for window in block_windows(src_ds):
+        xoff, yoff, xsize, ysize = window
+        for band in range(1, n_bands + 1):
+            cache[band - 1, yoff:yoff + ysize, xoff:xoff + xsize] = \
+                src_ds.GetRasterBand(band).ReadAsArray(*window)
+    cache.flush()
+    del cache
+
+    metadata = {
+        'source': os.path.abspath(img_path),
+        'nodata': [src_ds.GetRasterBand(b).GetNoDataValue() for b in range(1, n_bands + 1)],
+        'geotransform': src_ds.GetGeoTransform(),
+        'projection': src_ds.GetProjection()
+    }
+    with open(cache_path + '.json', 'w') as fp:
+        json.dump(metadata, fp)
+    return cache_path
+
+def open_dataset(path: str):
+    """
+    Open a raster in read mode once per thread (or process) and reuse it.
+
+    :path: Raster path.
+    """
+    if not hasattr(_local, 'datasets'):
+        _local.datasets = {}
+    if path not in _local.datasets:
+        _local.datasets[path] = open_raster(path)
+    return _local.datasets[path]
+
+def map_windows(func, tasks: list, workers: int = 1, pool: str = "thread"):
+    """
+    Apply a function to several tasks on a pool of workers, yielding the
+    results in the same order as the tasks.
+
+    Only a few tasks are queued ahead of the one being yielded, so the
+    memory used by pending results is bounded by the number of workers
+    and not by the number of tasks.
+
+    :func: Function to apply. With a process pool it must be defined at
+    module level.
+    :tasks: List with the function arguments (one per call).
+    :workers: Number of workers. With 1 the tasks run in this thread.
+    :pool: thread | process
+    """
+    if workers <= 1:
+        for task in tasks:
+            yield func(task)
+        return
+
+    if pool == "thread":
+        worker_pool = ThreadPool(workers)
+    elif pool == "process":
+        worker_pool = multiprocessing.Pool(workers)
+    else:
+        raise ValueError("The 'pool' parameter is not valid.")
+
+    with worker_pool:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(worker_pool.apply_async(func, (task,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+def block_windows(ds, window_pixels: int = WINDOW_PIXELS) -> list:
+    """
+    Split a raster in full width windows aligned to its native block layout.
+
+    Each window is a tuple (xoff, yoff, xsize, ysize). The window height is a
+    multiple of the native block height, so every block is decoded once.
+
+    :ds: GDAL dataset (or its path).
+    :window_pixels: Approximated number of pixels inside each window.
+    """
+    if isinstance(ds, str):
+        ds = open_raster(ds)
+
+    columns = ds.RasterXSize
+    rows = ds.RasterYSize
+    block_rows = ds.GetRasterBand(1).GetBlockSize()[1]
+
+    n_blocks = max(1, window_pixels // max(1, columns * block_rows))
+    window_rows = min(rows, n_blocks * block_rows)
+
+    windows = []
+    for yoff in range(0, rows, window_rows):
+        windows.append((0, yoff, columns, min(window_rows, rows - yoff)))
+    return windows
+
+def sample_windows(ds, fraction: float, mode: str = "stride", seed: int = 0) -> list:
+    """
+    Select a fraction of the native block rows of a raster, so only those
+    blocks are read and decoded.
+
+    :ds: GDAL dataset (or its path).
+    :fraction: Fraction of block rows to select (0 to 1).
+    :mode: stride (evenly spaced block rows) | random (random block rows)
+    :seed: Random seed (random mode).
+    return list of windows with the same format as block_windows().
+    """
+    if not 0 < fraction <= 1:
+        raise ValueError("The 'fraction' parameter must be between 0 and 1.")
+    # One native block row by window
+    windows = block_windows(ds, 1)
+    n = max(1, int(round(len(windows) * fraction)))
+
+    if mode == "stride":
+        idx = np.linspace(0, len(windows) - 1, n).round().astype(int)
+    elif mode == "random":
+        idx = np.random.default_rng(seed).choice(len(windows), n, replace=False)
+    else:
+        raise ValueError("The 'mode' parameter is not valid.")
+    return [windows[i] for i in np.unique(idx)]
+
+def native_chunks(ds, window_pixels: int = WINDOW_PIXELS) -> tuple:
+    """
+    Chunk shape (rows, columns) made of whole native blocks with about
+    window_pixels pixels. Striped rasters get full width chunks.
+
+    :ds: GDAL dataset (or its path).
+    :window_pixels: Approximated number of pixels inside each chunk.
+    """
+    if isinstance(ds, str):
+        ds = open_raster(ds)
+    columns = ds.RasterXSize
+    rows = ds.RasterYSize
+    block_cols, block_rows = ds.GetRasterBand(1).GetBlockSize()
+    block_cols = min(block_cols, columns)
+
+    n_blocks = max(1, window_pixels // max(1, block_cols * block_rows))
+    if block_cols == columns:
+        return (min(rows, n_blocks * block_rows), columns)
+    side = max(1, int(np.sqrt(n_blocks)))
+    return (min(rows, side * block_rows), min(columns, side * block_cols))
+
+def lazy_raster(path: str, bands: list = None, window_pixels: int = WINDOW_PIXELS):
+    """
+    Open a raster as a lazy dask array with shape (n_bands, rows, columns).
+
+    Nothing is read until the array is computed, and then only the chunks
+    used by the computation are read. The chunks are aligned to the native
+    blocks of the file, the values are converted to float32 and the nodata
+    pixels to NaN chunk by chunk.
+
+    :path: Raster path.
+    :bands: List with the bands (all of them by default).
+    :window_pixels: Approximated number of pixels inside each chunk.
+    """
+    ds = open_raster(path)
+    if bands is None:
+        bands = list(range(1, ds.RasterCount + 1))
+    chunks = native_chunks(ds, window_pixels)
+
+    arrays = [
+        da.from_array(
+            RasterArray(path, band),
+            chunks=chunks,
+            name=f'raster-{os.path.abspath(str(path))}-{band}',
+            lock=False,
+            fancy=False,
+            meta=np.empty((0, 0), dtype=np.float32)
+        )
+        for band in bands
+    ]
+    return da.stack(arrays)
+
+def read_window(ds, band: int, window: tuple):
+    """
+    Read a raster window as float32 array and its nodata mask.
+
+    :ds: GDAL dataset.
+    :band: Band number (starting from 1).
+    :window: Tuple (xoff, yoff, xsize, ysize).
+    return (array, mask) where mask is True in nodata pixels or None if
+    the band has no nodata value.
+    """
+    src_band = ds.GetRasterBand(band)
+    arr = src_band.ReadAsArray(*window).astype(np.float32, copy=False)
+
+    nodata = src_band.GetNoDataValue()
+    if nodata is None:
+        mask = None
+    elif np.isnan(nodata):
+        mask = np.isnan(arr)
+    else:
+        mask = arr == nodata
+    return arr, mask
+
+def create_output(path: str, ref_ds, n_bands: int = 1,
+data_type = gdal.GDT_Float32, options: list = None, driver_name: str = "GTiff"):
+    """
+    Create an empty raster with the same grid (size, geotransform and
+    projection) as a reference dataset.
+
+    :path: Output image path.
+    :ref_ds: GDAL dataset used as reference.
+    :n_bands: Number of bands in the output image.
+    :data_type: GDAL data type.
+    :options: Creation options.
+    :driver_name: GDAL driver (GTiff by default).
+    """
+    if options is None:
+        options = ['COMPRESS=DEFLATE', 'PREDICTOR=3']
+
+    driver = gdal.GetDriverByName(driver_name)
+    out_ds = driver.Create(
+        os.path.normpath(path),
+        ref_ds.RasterXSize,
+        ref_ds.RasterYSize,
+        n_bands,
+        data_type,
+        options=options
+    )
+
+    # set projection and geotransform
+    geotrs = ref_ds.GetGeoTransform()
+    if geotrs is not None:
+        out_ds.SetGeoTransform(geotrs)
+    prj = ref_ds.GetProjection()
+    if prj is not None:
+        out_ds.SetProjection(prj)
+    return out_ds
+
+def create_stack(path: str, ref_ds, bands: dict, driver_name: str = "GTiff",
+nodata: float = FLOAT32_NODATA):
+    """
+    Create an empty multiband raster to store many neochannels together.
+
+    GeoTIFF stacks are tiled with band interleaving, so reading one band
+    or one area does not decode the rest. Zarr stacks store the bands as
+    a chunked array. Each band gets its name as description and the
+    given metadata.
+
+    :path: Output image path.
+    :ref_ds: GDAL dataset (or its path) used as reference.
+    :bands: Band name as key and dict with band metadata as value. The
+    bands are created in the dict order.
+    :driver_name: GTiff | Zarr
+    :nodata: Nodata value of every band.
+    """
+    if driver_name not in STACK_OPTIONS:
+        raise ValueError("The 'driver_name' parameter is not valid.")
+    if isinstance(ref_ds, str):
+        ref_ds = gdal.Open(ref_ds, gdal.GA_ReadOnly)
+
+    out_ds = create_output(
+        path,
+        ref_ds,
+        len(bands),
+        options=STACK_OPTIONS[driver_name],
+        driver_name=driver_name
+    )
+
+    for i, (name, metadata) in enumerate(bands.items()):
+        out_band = out_ds.GetRasterBand(i + 1)
+        out_band.SetDescription(name)
+        out_band.SetNoDataValue(nodata)
+        out_band.SetMetadata({k: str(v) for k, v in metadata.items()})
+    return out_ds
+
+def overview_levels(ds, min_size: int = OVERVIEW_MIN_SIZE) -> list:
+    """
+    Overview factors (2, 4, 8...) of a raster, the same ones chosen by
+    gdaladdo when no levels are given.
+
+    :ds: GDAL dataset.
+    :min_size: The last overview is smaller than this size.
+    """
+    size = max(ds.RasterXSize, ds.RasterYSize)
+    levels = []
+    factor = 2
+    while size > min_size * factor // 2:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+def build_overview(task: tuple) -> str:
+    """
+    Build the internal overviews of one raster (worker function).
+
+    :task: Tuple (path, resampling).
+    return path
+    """
+    path, resampling = task
+    ds = gdal.Open(str(path), gdal.GA_Update)
+    if ds is None:
+        raise RuntimeError(f'Cannot open {path} to build its overviews.')
+
+    levels = overview_levels(ds)
+    if len(levels) > 0 and ds.BuildOverviews(resampling, levels) != 0:
+        raise RuntimeError(f'Overviews of {path} failed: {gdal.GetLastErrorMsg()}')
+    ds.FlushCache()
+    del ds
+    return path
+
+def build_overviews(paths: list, workers: int = 1, resampling: str = "NEAREST"):
+    """
+    Build the overviews of several rasters in one batch, instead of
+    calling gdaladdo once per output.
+
+    The rasters are processed at the same time by a pool of threads (GDAL
+    releases the GIL) and the overview blocks are compressed with all the
+    CPU cores (see OVERVIEW_CONFIG). Any failure raises a RuntimeError.
+
+    :paths: Raster paths. The rasters must be closed.
+    :workers: Number of rasters processed at the same time.
+    :resampling: GDAL resampling method (NEAREST as gdaladdo).
+    """
+    if len(paths) == 0:
+        return
+    print(f"..Build overviews of {len(paths)} images\n")
+
+    previous = {k: gdal.GetConfigOption(k) for k in OVERVIEW_CONFIG}
+    for k, v in OVERVIEW_CONFIG.items():
+        gdal.SetConfigOption(k, v)
+    try:
+        tasks = [(path, resampling) for path in paths]
+        for _ in map_windows(build_overview, tasks, min(workers, len(paths)), "thread"):
+            pass
+    finally:
+        for k, v in previous.items():
+            gdal.SetConfigOption(k, v)
+
+def stack_band(ds, name: str) -> int:
+    """
+    Return the band number of a named band inside a stack.
+
+    :ds: GDAL dataset created with create_stack().
+    :name: Band name.
+    """
+    for i in range(1, ds.RasterCount + 1):
+        if ds.GetRasterBand(i).GetDescription() == name:
+            return i
+    raise ValueError(f'Band {name} is not inside the stack.')
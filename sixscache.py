@@ -0,0 +1,258 @@
+"""____________________________________________________________________________
+Script Name:        sixscache.py
+Description:        Persistent cache of the 6S outputs. Every 6S run is stored
+                    as a JSON file named after the hash of its inputs, and an
+                    optional lookup table (LUT) over solar zenith, AOT and
+                    water vapour is interpolated, so most scenes of the same
+                    site and season never run the 6S executable.
+____________________________________________________________________________"""
+import os
+import json
+import tempfile
+import itertools
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+import manifest as mf
+
+# 6S outputs stored by entry
+OUTPUTS = ['Lp', 'tau2', 'Edir', 'Edif']
+
+# Scene parameters used as LUT axes
+LUT_AXES = ['solar_z', 'aot', 'h2o']
+
+# Maximum difference allowed between the scene and the LUT parameters that
+# are not LUT axes (month and day are corrected, see sun_distance_factor)
+LUT_TOLERANCE = {
+    'view_z': 0,
+    'view_a': 10,
+    'solar_a': 10,
+    'o3': 0.02,
+    'target_km': 0.05,
+    'sensor_altitude': 5
+}
+
+# Azimuth parameters (degrees), compared across the 0/360 wrap
+LUT_AZIMUTHS = ['view_a', 'solar_a']
+
+def write_json(path: str, content: dict):
+    """
+    Write a JSON file at once (through a temporary file in the same dir),
+    so workers running at the same time never read a half written file.
+
+    :path: File path.
+    :content: JSON serializable dict.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(content, fp, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def entry_inputs(params: dict, lowerWav: float, upperWav: float) -> dict:
+    """
+    Inputs of one 6S run (scene parameters and band wavelengths).
+
+    :params: Scene parameters returned by customfunctions.sixs_inputs()
+    :lowerWav: Start band wavelength (micrometers)
+    :upperWav: End band wavelength (micrometers)
+    """
+    inputs = dict(params)
+    inputs['lowerWav'] = lowerWav
+    inputs['upperWav'] = upperWav
+    return inputs
+
+def entry_path(cache_dir: str, inputs: dict) -> str:
+    """
+    Path of the cache entry of some 6S inputs.
+
+    :cache_dir: Cache folder.
+    :inputs: Dict returned by entry_inputs().
+    """
+    return os.path.join(cache_dir, 'runs', mf.fingerprint('6S', inputs) + '.json')
+
+def cached_entry(params: dict, lowerWav: float, upperWav: float, cache_dir: str) -> dict:
+    """
+    Return the stored 6S outputs of a band.
+
+    :params: Scene parameters returned by customfunctions.sixs_inputs()
+    :lowerWav: Start band wavelength (micrometers)
+    :upperWav: End band wavelength (micrometers)
+    :cache_dir: Cache folder.
+    return dict with Lp, tau2, Edir and Edif or None if 6S never ran with
+    these inputs.
+    """
+    path = entry_path(cache_dir, entry_inputs(params, lowerWav, upperWav))
+    if not os.path.exists(path):
+        return None
+    with open(path) as fp:
+        return json.load(fp)['outputs']
+
+def cached_run(run, params: dict, lowerWav: float, upperWav: float, cache_dir: str) -> dict:
+    """
+    Return the 6S outputs of a band from the cache, or run 6S and store
+    them.
+
+    :run: Function running 6S (customfunctions.run_sixs).
+    :params: Scene parameters returned by customfunctions.sixs_inputs()
+    :lowerWav: Start band wavelength (micrometers)
+    :upperWav: End band wavelength (micrometers)
+    :cache_dir: Cache folder.
+    return dict with Lp, tau2, Edir and Edif
+    """
+    outputs = cached_entry(params, lowerWav, upperWav, cache_dir)
+    if outputs is not None:
+        return outputs
+
+    inputs = entry_inputs(params, lowerWav, upperWav)
+    path = entry_path(cache_dir, inputs)
+    result = run(params, lowerWav, upperWav)
+    outputs = {k: float(result[k]) for k in OUTPUTS}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_json(path, {'inputs': inputs, 'outputs': outputs})
+    return outputs
+
+def sun_distance_factor(month: int, day: int) -> float:
+    """
+    Earth-Sun distance correction applied by 6S to the irradiances and
+    radiances (varsol subroutine).
+
+    :month: Month.
+    :day: Day of the month.
+    """
+    if month <= 2:
+        j = 31 * (month - 1) + day
+    elif month > 8:
+        j = 31 * (month - 1) - ((month - 2) // 2) - 2 + day
+    else:
+        j = 31 * (month - 1) - ((month - 1) // 2) - 2 + day
+    om = 0.9856 * (j - 4) * np.pi / 180
+    return 1 / (1 - 0.01673 * np.cos(om)) ** 2
+
+def build_lut(run, params: dict, lowerWav: float, upperWav: float, cache_dir: str,
+solar_z: list, aot: list, h2o: list) -> str:
+    """
+    Run 6S over a grid of solar zenith, AOT and water vapour values and
+    store it as a lookup table. The other parameters are taken from
+    params. Each grid point is also a cache entry, so an interrupted
+    build continues where it stopped. The params scene is run too, so
+    the scene that builds the LUT is never interpolated.
+
+    :run: Function running 6S (customfunctions.run_sixs).
+    :params: Scene parameters used as LUT base.
+    :lowerWav: Start band wavelength (micrometers)
+    :upperWav: End band wavelength (micrometers)
+    :cache_dir: Cache folder.
+    :solar_z: Solar zenith angles of the grid (increasing).
+    :aot: AOT at 550nm values of the grid (increasing).
+    :h2o: Water vapour values of the grid (increasing).
+    return LUT file path
+    """
+    axes = {'solar_z': list(solar_z), 'aot': list(aot), 'h2o': list(h2o)}
+    shape = tuple(len(axes[a]) for a in LUT_AXES)
+    outputs = {k: np.zeros(shape) for k in OUTPUTS}
+
+    print(f"..Build 6S LUT with {int(np.prod(shape))} runs ({lowerWav}-{upperWav})\n")
+    for idx in itertools.product(*[range(n) for n in shape]):
+        point = dict(params)
+        for axis, i in zip(LUT_AXES, idx):
+            point[axis] = axes[axis][i]
+        result = cached_run(run, point, lowerWav, upperWav, cache_dir)
+        for k in OUTPUTS:
+            outputs[k][idx] = result[k]
+    cached_run(run, params, lowerWav, upperWav, cache_dir)
+
+    base = {k: v for k, v in params.items() if k not in LUT_AXES}
+    path = os.path.join(cache_dir, 'lut', mf.fingerprint('LUT', base, lowerWav, upperWav, axes) + '.json')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_json(path, {
+        'base': base,
+        'lowerWav': lowerWav,
+        'upperWav': upperWav,
+        'axes': axes,
+        'outputs': {k: v.tolist() for k, v in outputs.items()}
+    })
+    return path
+
+def lut_match(lut: dict, params: dict, lowerWav: float, upperWav: float) -> bool:
+    """
+    Test if a scene can be interpolated from a LUT: same band, parameters
+    outside the LUT axes inside LUT_TOLERANCE and axes values inside the
+    grid.
+
+    :lut: LUT file content.
+    :params: Scene parameters.
+    :lowerWav: Start band wavelength (micrometers)
+    :upperWav: End band wavelength (micrometers)
+    """
+    if lut['lowerWav'] != lowerWav or lut['upperWav'] != upperWav:
+        return False
+    for k, tolerance in LUT_TOLERANCE.items():
+        diff = abs(lut['base'][k] - params[k])
+        if k in LUT_AZIMUTHS:
+            diff = min(diff % 360, 360 - diff % 360)
+        if diff > tolerance:
+            return False
+    for axis in LUT_AXES:
+        values = lut['axes'][axis]
+        if not values[0] <= params[axis] <= values[-1]:
+            return False
+    return True
+
+def lut_lookup(params: dict, lowerWav: float, upperWav: float, cache_dir: str) -> dict:
+    """
+    Interpolate the 6S outputs of a band from the stored LUTs.
+
+    The outputs are interpolated linearly along solar zenith, AOT and
+    water vapour, then corrected from the LUT date to the scene date
+    (Earth-Sun distance).
+
+    :params: Scene parameters.
+    :lowerWav: Start band wavelength (micrometers)
+    :upperWav: End band wavelength (micrometers)
+    :cache_dir: Cache folder.
+    return dict with Lp, tau2, Edir and Edif or None if no LUT matches.
+    """
+    lut_dir = os.path.join(cache_dir, 'lut')
+    if not os.path.isdir(lut_dir):
+        return None
+
+    for name in sorted(os.listdir(lut_dir)):
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(lut_dir, name)) as fp:
+            lut = json.load(fp)
+        if not lut_match(lut, params, lowerWav, upperWav):
+            continue
+
+        grid = [lut['axes'][axis] for axis in LUT_AXES]
+        point = [params[axis] for axis in LUT_AXES]
+        outputs = {
+            k: float(RegularGridInterpolator(grid, np.array(v))(point)[0])
+            for k, v in lut['outputs'].items()
+        }
+        # Radiances and irradiances depend on the Earth-Sun distance
+        factor = sun_distance_factor(params['month'], params['day']) / \
+            sun_distance_factor(lut['base']['month'], lut['base']['day'])
+        for k in ['Lp', 'Edir', 'Edif']:
+            outputs[k] *= factor
+        return outputs
+    return None
+
+def coefficients(run, params: dict, lowerWav: float, upperWav: float, cache_dir: str) -> dict:
+    """
+    6S outputs of a band: from the cache when 6S already ran with the
+    scene inputs, otherwise interpolated from a LUT that matches the
+    scene, otherwise running 6S (and storing the outputs).
+
+    :run: Function running 6S (customfunctions.run_sixs).
+    :params: Scene parameters returned by customfunctions.sixs_inputs()
+    :lowerWav: Start band wavelength (micrometers)
+    :upperWav: End band wavelength (micrometers)
+    :cache_dir: Cache folder.
+    return dict with Lp, tau2, Edir and Edif
+    """
+    outputs = cached_entry(params, lowerWav, upperWav, cache_dir)
+    if outputs is None:
+        outputs = lut_lookup(params, lowerWav, upperWav, cache_dir)
+    if outputs is not None:
+        return outputs
+    return cached_run(run, params, lowerWav, upperWav, cache_dir)